@@ -0,0 +1,192 @@
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import pygame
+
+from tile_pack import buffer_format
+
+MAGIC = b"OFFASSET\x01"
+
+# offset and length of the JSON index at the end of the file
+HEADER = struct.Struct("<QI")
+
+ALIGN = 16
+
+
+class AssetBundle(object):
+    """
+    Images and font glyphs, already scaled and in the display pixel format, memory-mapped from one file.
+
+    image() and glyphs() look an asset up in the bundle and wrap its pixels
+    with frombuffer, so startup does no PNG decoding, scaling or converting.
+    Anything missing from the bundle, or stored in a pixel format the display
+    does not use, is loaded the slow way and recorded; save() writes every
+    asset used so far, which is how `assets.py build` makes a bundle.
+
+    Assets are keyed by their path relative to `base`, the directory of the
+    bundle by default, so it does not matter how the caller spelled the path.
+    """
+
+    def __init__(self, path=None, base=None):
+        self.path = path
+        self.base = base or (os.path.dirname(os.path.abspath(path)) if path else os.getcwd())
+        self.index = {"sizes": {}, "entries": {}}
+        self.data = None
+        self.recorded = OrderedDict()
+        self.sizes = {}
+        self.sources = {}
+
+        if path is not None and os.path.exists(path):
+            with open(path, "rb") as f:
+                if f.read(len(MAGIC)) == MAGIC:
+                    offset, length = HEADER.unpack(f.read(HEADER.size))
+                    f.seek(offset)
+                    self.index = json.loads(f.read(length).decode("utf-8"))
+                    # copy-on-write, the pages stay shared with the page cache until a surface is drawn on
+                    self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+                else:
+                    print("ASSETS %s: not an asset bundle" % path)
+
+    def name(self, path):
+        return os.path.relpath(os.path.abspath(path), self.base)
+
+    def source(self, path):
+        image = self.sources.get(path)
+        if image is None:
+            image = self.sources[path] = pygame.image.load(path)
+            self.sizes[self.name(path)] = image.get_size()
+        return image
+
+    def source_size(self, path):
+        """
+        Size of the original image, without loading it when the bundle knows it.
+        """
+        name = self.name(path)
+        size = self.index["sizes"].get(name) or self.sizes.get(name)
+        if size is None:
+            size = self.source(path).get_size()
+        self.sizes[name] = tuple(size)
+        return tuple(size)
+
+    def lookup(self, key, alpha):
+        entry = self.index["entries"].get(key)
+        if entry is None or self.data is None:
+            return None
+
+        offset, length, width, height, fmt = entry
+        display = pygame.display.get_surface()
+        image = pygame.image.frombuffer(memoryview(self.data)[offset:offset + length], (width, height), fmt)
+        if display is not None:
+            if image.get_masks()[:3] != display.get_masks()[:3]:
+                image = image.convert_alpha() if alpha else image.convert()
+            elif not alpha:
+                image.set_alpha(None)
+        return image
+
+    def record(self, key, image):
+        self.recorded[key] = image
+        return image
+
+    def image(self, path, size=None, alpha=False):
+        """
+        The image at path, scaled to size and converted for the display.
+        """
+        key = "%s %s %s" % (self.name(path), "%dx%d" % tuple(size) if size else "-", "alpha" if alpha else "opaque")
+        image = self.lookup(key, alpha)
+        if image is not None:
+            return self.record(key, image)
+
+        image = self.source(path)
+        if size is not None and tuple(size) != image.get_size():
+            image = pygame.transform.scale(image, size)
+        if pygame.display.get_surface() is not None:
+            image = image.convert_alpha() if alpha else image.convert()
+        return self.record(key, image)
+
+    def glyphs(self, font, name, size, color, chars):
+        """
+        The chars of the font rendered in color, as a dict of surfaces.
+        """
+        glyphs = {}
+        for char in chars:
+            key = "%s %d %02x%02x%02x %04x" % ((self.name(name), size) + tuple(color[:3]) + (ord(char),))
+            image = self.lookup(key, True)
+            if image is None:
+                image = font.render(char, False, color)
+                if pygame.display.get_surface() is not None:
+                    image = image.convert_alpha()
+            glyphs[char] = self.record(key, image)
+        return glyphs
+
+    def save(self, path):
+        """
+        Write every asset used so far into a new bundle at path.
+        """
+        sizes = dict(self.index["sizes"])
+        sizes.update(self.sizes)
+        entries = {}
+
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(MAGIC + HEADER.pack(0, 0))
+            for key, image in self.recorded.items():
+                f.write(bytes(-f.tell() % ALIGN))
+                fmt = buffer_format(image) or "RGBA"
+                pixels = pygame.image.tobytes(image, fmt)
+                entries[key] = f.tell(), len(pixels), image.get_width(), image.get_height(), fmt
+                f.write(pixels)
+
+            index = json.dumps({"sizes": sizes, "entries": entries}).encode("utf-8")
+            offset = f.tell()
+            f.write(index)
+            f.seek(len(MAGIC))
+            f.write(HEADER.pack(offset, len(index)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        return len(entries), offset + len(index)
+
+
+def build(args):
+    if args.headless:
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+    sys.argv[0] = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dashboard.py")
+    import dashboard
+
+    pygame.init()
+    pygame.display.set_mode(dashboard.SCREEN_RESOLUTION)
+
+    dashboard.assets = AssetBundle(base=os.path.dirname(os.path.abspath(args.out)))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # the map only for its images, without the real pack, negative cache or tile source
+        start = time.perf_counter()
+        widgets = dashboard.create_widgets(pack=os.path.join(tmpdir, "maps.pack"), url=None, negative=None)
+        elapsed = time.perf_counter() - start
+        widgets[-1].close()
+
+    count, size = dashboard.assets.save(args.out)
+    print("%d assets, %d bytes in %s, loading them took %.0f ms" % (count, size, args.out, 1000 * elapsed))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Dashboard asset bundle")
+    commands = parser.add_subparsers(dest="command", required=True)
+    p = commands.add_parser("build", help="load every dashboard asset and write them into a bundle")
+    p.add_argument("--out", default="assets.bundle")
+    p.add_argument("--headless", action="store_true",
+                   help="use the dummy video driver; better run on the dashboard itself to get its pixel format")
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        build(args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
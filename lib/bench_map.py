@@ -0,0 +1,217 @@
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import pygame
+
+from map_maker import MapMaker, TILE_SIZE
+from tile_pack import TilePack, tree_tiles
+
+START = 384053, 6724400
+
+
+def route_pan(frames):
+    """
+    Steady 4 px per frame pan at level 8, east then north.
+    """
+    E, N = START
+    step = 4 * TILE_SIZE[8] // 240
+    for i in range(frames):
+        if i < frames // 2:
+            E += step
+        else:
+            N += step
+        yield E, N, 8
+
+
+def route_drive(frames):
+    """
+    80 km/h along a wide curve at level 10, 20 frames per second.
+    """
+    E, N = START
+    bearing = 0
+    for i in range(frames):
+        bearing += 0.5
+        E += 80 / 3.6 / 20 * math.sin(math.radians(bearing))
+        N += 80 / 3.6 / 20 * math.cos(math.radians(bearing))
+        yield round(E), round(N), 10
+
+
+def route_zoom(frames):
+    """
+    Zoom in and out through levels 4-10 every 10 frames while standing still.
+    """
+    levels = list(range(4, 11)) + list(range(9, 4, -1))
+    for i in range(frames):
+        yield START[0], START[1], levels[i // 10 % len(levels)]
+
+
+def route_jump(frames):
+    """
+    Jump to a random place every 5 frames, always a full re-composite.
+    """
+    rnd = random.Random(1)
+    E, N = START
+    for i in range(frames):
+        if i % 5 == 0:
+            E = START[0] + rnd.randrange(-50000, 50000)
+            N = START[1] + rnd.randrange(-50000, 50000)
+        yield E, N, 8
+
+
+ROUTES = {"pan": route_pan, "drive": route_drive, "zoom": route_zoom, "jump": route_jump}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def run_route(screen, name, args, pack, url):
+    map = MapMaker((300, 0, 980, 800), pack=pack, url=url, negative=None, cache_bytes=args.cache_mb * 1024 * 1024)
+    map.set_heading_up(args.heading_up)
+
+    times = []
+    interval = 1 / args.fps if args.fps else 0
+    start = time.perf_counter()
+    last, heading = None, 0
+    for E, N, level in ROUTES[name](args.frames):
+        if last is not None and (E, N) != last:
+            heading = math.degrees(math.atan2(E - last[0], N - last[1]))
+        last = E, N
+
+        t0 = time.perf_counter()
+        map.draw(screen, E, N, level, heading=heading)
+        map.draw_fov(screen, 45, (255, 0, 0))
+        times.append(time.perf_counter() - t0)
+
+        if interval:
+            time.sleep(max(0, interval - (time.perf_counter() - t0)))
+    elapsed = time.perf_counter() - start
+
+    stats = map.tiles.stats()
+    map.close()
+    return {
+        "frames": len(times),
+        "seconds": elapsed,
+        "frame_ms": {
+            "p50": 1000 * percentile(times, 50),
+            "p95": 1000 * percentile(times, 95),
+            "p99": 1000 * percentile(times, 99),
+            "max": 1000 * max(times),
+            "mean": 1000 * sum(times) / len(times),
+        },
+        "tiles_decoded": map.loaded,
+        "tiles_decoded_per_s": map.loaded / elapsed,
+        "cache_hit_rate": stats["hit_rate"],
+        "cache_evictions": stats["evictions"],
+    }
+
+
+def git_version():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def prepare(args, tmpdir):
+    """
+    Return the pack path and tile URL to benchmark against.
+    """
+    if args.tree:
+        pack = TilePack(os.path.join(tmpdir, "tree.pack"))
+        for tile, path in tree_tiles(args.tree):
+            with open(path, "rb") as f:
+                pack.put(tile, f.read())
+        pack.close()
+        return pack.path, None
+
+    if args.synthetic:
+        from tile_server import TileServer, SyntheticTiles
+
+        server = TileServer(("127.0.0.1", 0), SyntheticTiles())
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return os.path.join(tmpdir, "synthetic.pack"), server.url
+
+    return args.pack, None
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results["routes"].items():
+        old = baseline["routes"].get(name)
+        if old is None:
+            continue
+        for p in ("p50", "p95", "p99"):
+            if result["frame_ms"][p] > old["frame_ms"][p] * (1 + tolerance):
+                regressions.append("%s %s %.2f ms -> %.2f ms" % (name, p, old["frame_ms"][p], result["frame_ms"][p]))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Headless MapMaker benchmark")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--pack", default="maps.pack", help="tile pack to read, no network")
+    source.add_argument("--tree", help="maps/level/col/row.png tree, imported into a temporary pack")
+    source.add_argument("--synthetic", action="store_true", help="generated tiles from an in-process tile server")
+    parser.add_argument("--routes", nargs="+", choices=sorted(ROUTES), default=sorted(ROUTES))
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--fps", type=float, default=20, help="frame pacing, 0 for as fast as possible")
+    parser.add_argument("--cache-mb", type=int, default=64)
+    parser.add_argument("--heading-up", action="store_true", help="rotate the map by the direction of travel")
+    parser.add_argument("--out", default="bench_map.json", help="machine-readable results")
+    parser.add_argument("--baseline", help="earlier results to compare p50/p95/p99 against")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    args = parser.parse_args(argv)
+
+    pygame.display.init()
+    screen = pygame.display.set_mode((1280, 800))
+
+    results = {
+        "version": git_version(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "pygame": pygame.version.ver,
+        "machine": platform.machine(),
+        "args": vars(args),
+        "routes": {},
+    }
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pack, url = prepare(args, tmpdir)
+        for name in args.routes:
+            result = results["routes"][name] = run_route(screen, name, args, pack, url)
+            print("%-6s p50 %6.2f ms  p95 %6.2f ms  p99 %6.2f ms  %7.1f tiles/s  hit rate %5.1f%%" % (
+                name, result["frame_ms"]["p50"], result["frame_ms"]["p95"], result["frame_ms"]["p99"],
+                result["tiles_decoded_per_s"], 100 * result["cache_hit_rate"]))
+
+    results["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("peak RSS %d kB" % results["peak_rss_kb"])
+
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print("REGRESSION " + line)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,167 @@
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+
+from telemetry import (BINARY, JSON, PACKET, FrameBuffer, OrientationFilter, TelemetryServer, decode_imu_batch,
+                       encode_frame, pack_imu_batch, pack_packet, read_frame, synthetic_packet)
+
+
+def concat(sock, count):
+    """
+    The original android_reader loop: two 1-byte reads for the header, then += until the frame is complete.
+    """
+    size = 0
+    for _ in range(count):
+        h = sock.recv(1)
+        l = sock.recv(1)
+        length = 256 * ord(h) + ord(l)
+
+        data = bytes()
+        while len(data) < length:
+            data += sock.recv(length - len(data))
+        size += len(data)
+    return size
+
+
+def frame_buffer(sock, count):
+    frames = FrameBuffer()
+    size = 0
+    while count:
+        frames.recv_into(sock)
+        for _, frame in frames.frames():
+            size += len(frame)
+            count -= 1
+    return size
+
+
+def stream_reader(sock, count):
+    async def run():
+        reader, writer = await asyncio.open_connection(sock=sock)
+        size = 0
+        for _ in range(count):
+            size += len((await read_frame(reader))[1])
+        writer.transport.pause_reading()
+        return size
+
+    return asyncio.run(run())
+
+
+METHODS = {"concat": concat, "framebuffer": frame_buffer, "readexactly": stream_reader}
+
+
+def run(method, stream, chunk, count, trace):
+    receiver, sender = socket.socketpair()
+
+    def send():
+        view = memoryview(stream)
+        for i in range(0, len(stream), chunk):
+            sender.sendall(view[i:i + chunk])
+
+    thread = threading.Thread(target=send)
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    thread.start()
+    size = METHODS[method](receiver, count)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] if trace else 0
+    if trace:
+        tracemalloc.stop()
+    thread.join()
+    receiver.close()
+    sender.close()
+    return elapsed, peak, size
+
+
+def decode_json(frames):
+    for frame in frames:
+        data = json.loads(frame)
+        angles = data["orientation_angles"]
+        loc = data["location"]
+        (angles["azimuth"], angles["pitch"], angles["roll"], loc["latitude"], loc["longitude"], loc["speed"],
+         loc["bearing"], loc["altitude"])
+
+
+def decode_binary(frames):
+    unpack = PACKET.unpack_from
+    for frame in frames:
+        unpack(frame)
+
+
+def decode_imu(frames, imu):
+    for frame in frames:
+        start, offsets, *channels = decode_imu_batch(frame)
+        if imu is not None:
+            imu.update(start, offsets, channels, 0)
+
+
+def decode(count, batch):
+    """
+    Per-packet cost of the two frame formats, first to the phone's values, then all the way to telemetry fields.
+
+    IMU batches are timed the same way, decoding only and with the filter.
+    """
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    import dashboard
+
+    packets = [synthetic_packet(i / 20) for i in range(count)]
+    json_frames = [json.dumps(packet).encode("utf-8") for packet in packets]
+    binary_frames = [pack_packet(packet) for packet in packets]
+    server = TelemetryServer(rate=20, imu_rate=20 * batch)
+    imu_frames = [pack_imu_batch(i / 20, list(server.imu_samples(i / 20))) for i in range(count)]
+    print("JSON packets of %d bytes, binary packets of %d bytes, IMU batches of %d samples in %d bytes" % (
+        len(json_frames[0]), PACKET.size, batch, len(imu_frames[0])))
+    print("%-12s %12s %12s" % ("decode", "us/packet", "packets/s"))
+
+    runs = [
+        ("json", lambda: decode_json(json_frames)),
+        ("binary", lambda: decode_binary(binary_frames)),
+        ("json+parse", lambda: [dashboard.parse_frame(frame, JSON) for frame in json_frames]),
+        ("binary+parse", lambda: [dashboard.parse_frame(frame, BINARY) for frame in binary_frames]),
+        ("imu", lambda: decode_imu(imu_frames, None)),
+        ("imu+filter", lambda: decode_imu(imu_frames, OrientationFilter())),
+    ]
+    for name, run in runs:
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        print("%-12s %12.2f %12.0f" % (name, 1e6 * elapsed / count, count / elapsed))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Telemetry frame reassembly and decoding benchmark")
+    parser.add_argument("--frames", type=int, default=100000)
+    parser.add_argument("--chunks", type=int, nargs="+", default=[16, 256, 4096, 65536],
+                        help="bytes per send, small sends split frames, large ones carry many")
+    parser.add_argument("--methods", nargs="+", choices=sorted(METHODS), default=list(METHODS))
+    parser.add_argument("--decode", action="store_true", help="compare decoding JSON and binary packets instead")
+    parser.add_argument("--imu-batch", type=int, default=20, help="samples per IMU batch for --decode")
+    args = parser.parse_args(argv)
+
+    if args.decode:
+        decode(args.frames, args.imu_batch)
+        return
+
+    frame = encode_frame(json.dumps(synthetic_packet(0)).encode("utf-8"))
+    stream = frame * args.frames
+    print("%d frames of %d bytes" % (args.frames, len(frame)))
+    print("%-12s %8s %12s %12s %12s" % ("method", "chunk", "us/frame", "frames/s", "peak KB"))
+
+    for chunk in args.chunks:
+        for method in args.methods:
+            elapsed, _, size = run(method, stream, chunk, args.frames, False)
+            assert size == args.frames * (len(frame) - 2)
+            # a shorter traced run, tracemalloc slows everything down
+            _, peak, _ = run(method, frame * (args.frames // 10), chunk, args.frames // 10, True)
+            print("%-12s %8d %12.2f %12.0f %12.1f" % (
+                method, chunk, 1e6 * elapsed / args.frames, args.frames / elapsed, peak / 1024))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
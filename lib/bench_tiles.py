@@ -0,0 +1,91 @@
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import pygame
+
+from tile_pack import TilePack, FORMAT_PNG, buffer_format, encode_raw, decode_tile, tree_tiles
+
+
+def timed(fn, items, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for item in items:
+            fn(item)
+    return (time.perf_counter() - start) / (repeat * len(items)) * 1e6
+
+
+def load_sources(args):
+    if args.tree:
+        pngs = []
+        for tile, path in tree_tiles(args.tree):
+            with open(path, "rb") as f:
+                pngs.append(f.read())
+            if len(pngs) == args.tiles:
+                break
+        return pngs
+
+    pack = TilePack(args.pack, writable=False)
+    pngs = [pack.get(tile) for tile in pack.tiles() if pack.index[tile][2] == FORMAT_PNG][:args.tiles]
+    pack.close()
+    return pngs
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Compare PNG and pre-decoded raw tile load and blit cost")
+    parser.add_argument("--pack", default="maps.pack")
+    parser.add_argument("--tree", help="read PNG tiles from a maps/ tree instead of a pack")
+    parser.add_argument("--tiles", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args(argv)
+
+    pygame.display.init()
+    screen = pygame.display.set_mode((1280, 800))
+    fmt = buffer_format(screen)
+
+    pngs = load_sources(args)
+    if not pngs:
+        sys.exit("no PNG tiles found")
+
+    raws = [encode_raw(pygame.image.load(io.BytesIO(png), "tile.png").convert(), fmt) for png in pngs]
+    zlibs = [encode_raw(pygame.image.load(io.BytesIO(png), "tile.png").convert(), fmt, True) for png in pngs]
+
+    load = {
+        "png": timed(lambda png: pygame.image.load(io.BytesIO(png), "tile.png"), pngs, args.repeat),
+        "png+convert": timed(lambda png: decode_tile(png, FORMAT_PNG), pngs, args.repeat),
+        "raw": timed(lambda raw: decode_tile(*raw), raws, args.repeat),
+        "raw+zlib": timed(lambda raw: decode_tile(*raw), zlibs, args.repeat),
+    }
+    surfaces = {
+        "png": [pygame.image.load(io.BytesIO(png), "tile.png") for png in pngs],
+        "png+convert": [decode_tile(png, FORMAT_PNG) for png in pngs],
+        "raw": [decode_tile(*raw) for raw in raws],
+        "raw+zlib": [decode_tile(*raw) for raw in zlibs],
+    }
+    blit = {name: timed(lambda image: screen.blit(image, (0, 0)), images, args.repeat)
+            for name, images in surfaces.items()}
+    size = {
+        "png": sum(map(len, pngs)) / len(pngs),
+        "png+convert": sum(map(len, pngs)) / len(pngs),
+        "raw": sum(len(raw[0]) for raw in raws) / len(raws),
+        "raw+zlib": sum(len(raw[0]) for raw in zlibs) / len(zlibs),
+    }
+
+    print("%d tiles, display format %s" % (len(pngs), fmt))
+    print("%-12s %10s %10s %10s" % ("", "load us", "blit us", "bytes"))
+    for name in load:
+        print("%-12s %10.1f %10.1f %10d" % (name, load[name], blit[name], size[name]))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"tiles": len(pngs), "format": fmt, "load_us": load, "blit_us": blit, "bytes": size}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
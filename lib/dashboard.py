@@ -1,16 +1,30 @@
+import time
+
+# taken before pygame is imported, for the time to first frame
+STARTED = time.monotonic()
+
 import json
 import os
-import socket
-import threading
+from collections import OrderedDict
 import math
 
 import pygame
 import sys
 
 import map_maker
+from assets import AssetBundle
 from map_maker import MapMaker
+from frame_stats import FrameStats
+from prefetch import Prefetcher
+from scheduler import RenderScheduler
+from static_layer import StaticLayer
+from telemetry import (BINARY, FIELDS, IMU_BATCH, JSON, PACKET, OrientationFilter, TelemetryClient,
+                       TelemetryHistory, TelemetrySnapshot, decode_imu_batch)
 
 font_cache = {}
+atlas_cache = {}
+
+ATLAS_CHARS = "0123456789-+., "
 
 
 def get_font(name, size):
@@ -20,42 +34,92 @@ def get_font(name, size):
     size_cache = font_cache[name]
     if size not in size_cache:
         f = pygame.font.Font(name, size)
-        size_cache[size] = (pygame.font.Font(name, size), f.render("0", False, (0, 0, 0)).get_size())
+        size_cache[size] = (f, f.size("0"))
 
     return size_cache[size]
 
 
-def calculate_ratio(img, w, h):
+def get_atlas(name, size, color):
+    key = name, size, color
+    if key not in atlas_cache:
+        font = get_font(name, size)
+        atlas_cache[key] = GlyphAtlas(font, color, glyphs=assets.glyphs(font[0], name, size, color, ATLAS_CHARS))
+
+    return atlas_cache[key]
+
+
+class GlyphAtlas(object):
+    """
+    Glyphs of one font, size and color rendered once, plus an LRU cache of whole rendered strings.
+    """
+
+    def __init__(self, font, color, chars=ATLAS_CHARS, max_strings=256, glyphs=None):
+        self.font, self.cell = font
+        self.color = color
+        self.glyphs = dict(glyphs or {})
+        self.strings = OrderedDict()
+        self.max_strings = max_strings
+
+        for char in chars:
+            self.glyph(char)
+
+    def glyph(self, char):
+        img = self.glyphs.get(char)
+        if img is None:
+            img = self.glyphs[char] = self.font.render(char, False, self.color)
+        return img
+
+    def render(self, txt, monospace=False):
+        key = txt, monospace
+        img = self.strings.get(key)
+        if img is not None:
+            self.strings.move_to_end(key)
+            return img
+
+        if monospace:
+            w, h = self.cell
+            key_color = (255, 0, 255) if self.color != (255, 0, 255) else (0, 255, 0)
+            img = pygame.Surface((len(txt) * w, h))
+            img.fill(key_color)
+            img.set_colorkey(key_color, pygame.RLEACCEL)
+            for i, char in enumerate(txt):
+                glyph = self.glyph(char)
+                img.blit(glyph, (i * w + round(w / 2 - glyph.get_width() / 2), 0))
+        else:
+            img = self.font.render(txt, False, self.color)
+
+        self.strings[key] = img
+        if len(self.strings) > self.max_strings:
+            self.strings.popitem(last=False)
+        return img
+
+
+def calculate_ratio(size, w, h):
+    width, height = size
     if w and h:
-        y_ratio = h / img.get_height()
-        x_ratio = w / img.get_width()
+        y_ratio = h / height
+        x_ratio = w / width
 
         return min(y_ratio, x_ratio)
     elif w:
-        return w / img.get_width()
+        return w / width
     elif h:
-        return h / img.get_height()
+        return h / height
     else:
         return 1.0
 
 
-def scale_image(img, ratio):
-    return pygame.transform.scale(img, (round(img.get_width() * ratio), round(img.get_height() * ratio)))
-
+def scaled_size(size, ratio):
+    return round(size[0] * ratio), round(size[1] * ratio)
 
-def blit_monospace(surface, rect, font, txt, color):
-    font, size = font
-    x = rect.centerx - len(txt) * (size[0] // 2)
-    y = rect.centery - size[1] // 2
 
-    for a in txt:
-        rendered = font.render(a, False, color)
-        surface.blit(rendered, (x + round(size[0] / 2 - rendered.get_size()[0] / 2), y))
-        x += size[0]
+def blit_monospace(surface, rect, atlas, txt):
+    w, h = atlas.cell
+    surface.blit(atlas.render(txt, monospace=True), (rect.centerx - len(txt) * (w // 2), rect.centery - h // 2))
 
 
 class Meter(object):
-    def __init__(self, geometry, frame_color, bg_color, warn_color, txt_color):
+    def __init__(self, geometry, frame_color, bg_color, warn_color, txt_color, layer=None):
         super().__init__()
         self.frame_color = frame_color
         self.bg_color = bg_color
@@ -64,58 +128,126 @@ class Meter(object):
         self.warn_color = warn_color
 
         self.rect = pygame.Rect(*geometry)
+        self.layer = layer or StaticLayer(self.rect.bottomright)
+        self.state = None
+
+    @property
+    def inner(self):
+        return self.rect.inflate(-6, -6)
+
+    def static_key(self, color):
+        return tuple(self.rect), color, self.frame_color
+
+    def draw_static(self, surface, color):
+        surface.fill(color, self.rect)
+        pygame.draw.rect(surface, self.frame_color, self.rect, 3)
+
+    def changed(self, *state, force=False):
+        """
+        Remember the inputs of this frame and tell whether they differ from the last drawn ones.
+        """
+        if state == self.state and not force:
+            return False
+        self.state = state
+        return True
 
 
 class AngleMeter(Meter):
     def __init__(self, image_file, geometry, frame_color=(0x98, 0x6c, 0x6a), bg_color=(0x78, 0x4f, 0x41),
-                 warn_color=(128, 0, 0), txt_color=(0xb3, 0x99, 0x22), ratio=None):
-        super().__init__(geometry, frame_color, bg_color, warn_color, txt_color)
+                 warn_color=(128, 0, 0), txt_color=(0xb3, 0x99, 0x22), ratio=None, max_sprites=181, prerender=False,
+                 layer=None):
+        super().__init__(geometry, frame_color, bg_color, warn_color, txt_color, layer)
 
-        self.orig_img = pygame.image.load(os.path.join(directory, image_file))
+        image_path = os.path.join(directory, image_file)
+        size = assets.source_size(image_path)
 
         self.ratio = ratio
         if self.ratio is None:
-            self.ratio = calculate_ratio(self.orig_img, 0.8 * self.rect.width, 0.8 * self.rect.height)
+            self.ratio = calculate_ratio(size, 0.8 * self.rect.width, 0.8 * self.rect.height)
 
-        self.font, self.font_width = get_font("fonts/bummer.ttf", round(0.3 * self.rect.height))
+        self.img = assets.image(image_path, scaled_size(size, self.ratio), alpha=True)
 
-    def draw(self, surface, angle, color):
-        img = self.orig_img
-        img = scale_image(img, self.ratio)
-        img = pygame.transform.rotate(img, angle)
-        surface.fill(color, self.rect)
+        self.sprites = OrderedDict()
+        self.max_sprites = max_sprites
+        if prerender:
+            for angle in range(-90, 91):
+                self.sprite(angle)
+
+        self.atlas = get_atlas("fonts/bummer.ttf", round(0.3 * self.rect.height), self.txt_color)
+
+    def sprite(self, angle):
+        """
+        Return the scaled image rotated to the nearest whole degree, from a bounded LRU cache.
+        """
+        angle = round(angle)
+        img = self.sprites.get(angle)
+        if img is None:
+            img = pygame.transform.rotate(self.img, angle)
+            self.sprites[angle] = img
+            if len(self.sprites) > self.max_sprites:
+                self.sprites.popitem(last=False)
+        else:
+            self.sprites.move_to_end(angle)
+        return img
+
+    def draw(self, surface, angle, color, force=False):
+        force = self.layer.update(self, color) or force
+        if not self.changed(angle, color, force=force):
+            return []
 
+        self.layer.restore(surface, self.rect)
+        surface.set_clip(self.inner)
+
+        img = self.sprite(angle)
         img_rect = img.get_rect(center=(self.rect.centerx, self.rect.y + 0.4*self.rect.height))
         surface.blit(img, img_rect)
-        pygame.draw.rect(surface, self.frame_color, self.rect, 3)
 
-        txt = self.font.render(str(abs(angle)), False, self.txt_color)
+        txt = self.atlas.render(str(abs(angle)))
         txt_width, txt_height = txt.get_size()
         surface.blit(txt, (self.rect.centerx - 0.5 * txt_width, self.rect.bottom - txt_height - 4))
 
+        surface.set_clip(None)
+        return [self.rect]
+
 
 class SpeedoMeter(Meter):
     def __init__(self, geometry, frame_color=(0x98, 0x6c, 0x6a), bg_color=(0x78, 0x4f, 0x41), warn_color=(128, 0, 0),
-                 txt_color=(0xb3, 0x99, 0x22), fmt="%3d"):
-        super().__init__(geometry, frame_color, bg_color, warn_color, txt_color)
+                 txt_color=(0xb3, 0x99, 0x22), fmt="%3d", layer=None):
+        super().__init__(geometry, frame_color, bg_color, warn_color, txt_color, layer)
 
         self.fmt = fmt
-        self.font = get_font("fonts/bummer.ttf", round(0.8 * self.rect.height))
+        self.atlas = get_atlas("fonts/bummer.ttf", round(0.8 * self.rect.height), self.txt_color)
 
-    def draw(self, surface, speed, color):
-        surface.fill(color, self.rect)
-        pygame.draw.rect(surface, self.frame_color, self.rect, 3)
+    def draw(self, surface, speed, color, force=False):
+        force = self.layer.update(self, color) or force
+        txt = self.fmt % speed
+        if not self.changed(txt, color, force=force):
+            return []
 
-        blit_monospace(surface, self.rect, self.font, self.fmt % speed, self.txt_color)
+        self.layer.restore(surface, self.rect)
+        surface.set_clip(self.inner)
+        blit_monospace(surface, self.rect, self.atlas, txt)
+        surface.set_clip(None)
+        return [self.rect]
 
 
 class Compass(Meter):
     def __init__(self, image_file, geometry, frame_color=(0x98, 0x6c, 0x6a), bg_color=(0x78, 0x4f, 0x41),
-                 warn_color=(128, 0, 0), txt_color=(0xb3, 0x99, 0x22)):
-        super().__init__(geometry, frame_color, bg_color, warn_color, txt_color)
+                 warn_color=(128, 0, 0), txt_color=(0xb3, 0x99, 0x22), layer=None):
+        super().__init__(geometry, frame_color, bg_color, warn_color, txt_color, layer)
 
-        self.orig_img = pygame.image.load(os.path.join(directory, image_file))
-        self.ratio = calculate_ratio(self.orig_img, 0.8 * self.rect.width, 0.8 * self.rect.height)
+        self.orig_img = assets.image(os.path.join(directory, image_file), alpha=True)
+        self.ratio = calculate_ratio(self.orig_img.get_size(), 0.8 * self.rect.width, 0.8 * self.rect.height)
+
+    def static_key(self):
+        return tuple(self.rect), self.bg_color, self.frame_color
+
+    def draw_static(self, surface):
+        super().draw_static(surface, self.bg_color)
+
+        img = self.orig_img
+        img_rect = img.get_rect(center=self.rect.center)
+        surface.blit(img, img_rect)
 
     def rotate(self, angle):
         """
@@ -131,135 +263,211 @@ class Compass(Meter):
         qy = oy + math.sin(angle) * (px - ox) + math.cos(angle) * (py - oy)
         return round(qx), round(qy)
 
-    def draw(self, surface, *angles):
-        surface.fill(self.bg_color, self.rect)
-        pygame.draw.rect(surface, self.frame_color, self.rect, 3)
+    def draw(self, surface, *angles, force=False):
+        force = self.layer.update(self) or force
+        if not self.changed(*angles, force=force):
+            return []
 
-        img = self.orig_img
-
-        img_rect = img.get_rect(center=self.rect.center)
-        surface.blit(img, img_rect)
+        self.layer.restore(surface, self.rect)
         for angle, color in angles:
             pygame.draw.circle(surface, color, self.rotate(angle), 6, 0)
+        return [self.rect]
 
 
-def read_socket(sock, amount):
-    while True:
-        try:
-            data = sock.recv(amount)
-            if not data:
-                raise RuntimeError("Socket closed")
-            return data
-        except socket.timeout:
-            pass
-
-
-def android_reader():
-    global azimuth, pitch, roll, speed, bearing, gps_east, gps_north, altitude
-    # Create a TCP/IP socket
-    while running:
-        try:
-            sock = socket.socket()
-            sock.settimeout(0.5)
-            sock.connect(("192.168.43.1", 3451))
+def parse_packet(data):
+    """
+    Telemetry values in FIELDS order from one decoded JSON packet.
+    """
+    angles = data["orientation_angles"]
+    loc = data["location"]
+    gps_east, gps_north = map_maker.WGS84_to_TM35FIN(loc["latitude"], loc["longitude"])
+    return (angles["azimuth"], angles["pitch"], angles["roll"], round(3.6 * loc["speed"]), loc["bearing"],
+            gps_east, gps_north, loc["altitude"])
+
 
-            print(repr(sock))
+def parse_binary(data):
+    """
+    Telemetry values in FIELDS order from one binary packet, without building any dicts.
+    """
+    if len(data) != PACKET.size:
+        raise ValueError("binary packet of %d bytes, expected %d" % (len(data), PACKET.size))
+    azimuth, pitch, roll, latitude, longitude, speed, bearing, altitude = PACKET.unpack_from(data)
+    gps_east, gps_north = map_maker.WGS84_to_TM35FIN(latitude, longitude)
+    return azimuth, pitch, roll, round(3.6 * speed), bearing, gps_east, gps_north, altitude
 
-            while running:
-                h = read_socket(sock, 1)
-                l = read_socket(sock, 1)
 
-                json_len = 256 * ord(h) + ord(l)
+def parse_frame(data, kind=JSON):
+    return parse_binary(data) if kind == BINARY else parse_packet(json.loads(bytes(data)))
 
-                data = bytes()
-                while len(data) < json_len:
-                    data += read_socket(sock, json_len - len(data))
 
-                data = json.loads(data.decode("utf-8"))
+def update_telemetry(snapshot, kind, data, imu, now):
+    """
+    The snapshot that follows snapshot after one frame received at now.
 
-                angles = data["orientation_angles"]
-                azimuth = angles["azimuth"]
-                pitch = angles["pitch"]
-                roll = angles["roll"]
+    A packet brings new values, but while IMU batches keep coming its angles
+    are ignored in favour of the filtered ones. An IMU batch only updates
+    the angles, rounded to whole degrees like the phone sends them so the
+    meters redraw only when the value they show changes.
+    """
+    if kind == IMU_BATCH:
+        start, offsets, *channels = decode_imu_batch(data)
+        azimuth, pitch, roll = (round(angle) for angle in imu.update(start, offsets, channels, now))
+        return TelemetrySnapshot(tuple(snapshot.replace(azimuth=azimuth, pitch=pitch, roll=roll)),
+                                 snapshot.seq + 1, now)
 
-                loc = data["location"]
-                speed = round(3.6 * loc["speed"])
-                bearing = loc["bearing"]
-                la = loc["latitude"]
-                lo = loc["longitude"]
-                gps_east, gps_north = map_maker.WGS84_to_TM35FIN(la, lo)
-                altitude = loc["altitude"]
+    snapshot = TelemetrySnapshot(parse_frame(data, kind), snapshot.seq + 1, now)
+    if imu.updated is not None and now - imu.updated < IMU_TIMEOUT:
+        azimuth, pitch, roll = (round(angle) for angle in imu.state)
+        snapshot = snapshot.replace(azimuth=azimuth, pitch=pitch, roll=roll)
+    return snapshot
 
-        except (RuntimeError, ConnectionError, OSError) as e:
-            print(e)
-            pygame.time.wait(2000)
+
+def on_frame(source, kind, data):
+    global telemetry
+
+    snapshot = update_telemetry(telemetry, kind, data, imu, time.monotonic())
+    history.append(snapshot)
+    # one reference swap, the render loop sees either the old packet or the new one
+    telemetry = snapshot
+
+    scheduler.wake()
 
 
 SCREEN_RESOLUTION = (1280, 800)
+DIRTY_RECTS = True
+MIN_FPS = 1
+MAX_FPS = 20
+HEADING_UP = False
+FRAME_STATS_LOG = None  # e.g. "frames.csv"
+ASSET_BUNDLE = "assets.bundle"
+MAP_CACHE_BYTES = 96 * 1024 * 1024
+TELEMETRY_SOURCES = [("192.168.43.1", 3451)]
+IMU_CUTOFF = 4  # Hz
+IMU_TIMEOUT = 1  # s without IMU batches before packet angles are used again
 
 directory, file = os.path.split(os.path.abspath(sys.argv[0]))
+assets = AssetBundle(os.path.join(directory, ASSET_BUNDLE))
 
-pitch = 0
-roll = 0
-speed = 0
-azimuth = 0
-bearing = 0
-man_east = gps_east = 410000
-man_north = gps_north = 6750000
-altitude = 100
-running = True
+telemetry = TelemetrySnapshot((0, 0, 0, 0, 0, 410000, 6750000, 100))
+history = TelemetryHistory()
+imu = OrientationFilter(IMU_CUTOFF)
+man_east = telemetry.gps_east
+man_north = telemetry.gps_north
+scheduler = RenderScheduler(MIN_FPS, MAX_FPS)
+stats = FrameStats(log=FRAME_STATS_LOG)
 
 
 def main():
-    global running
-
     pygame.init()
 
-    t = threading.Thread(target=android_reader)
-    t.start()
+    client = TelemetryClient(TELEMETRY_SOURCES, on_frame)
+    client.start()
 
     pygame.display.set_caption("Offroad")
 
     try:
-        main_loop()
+        screen = pygame.display.set_mode(SCREEN_RESOLUTION, pygame.FULLSCREEN)
+        pygame.mouse.set_cursor((8, 8), (0, 0), (0, 0, 0, 0, 0, 0, 0, 0), (0, 0, 0, 0, 0, 0, 0, 0))
+        # pygame.mouse.set_visible(False)
+
+        widgets = create_widgets()
+        try:
+            main_loop(screen, widgets)
+        finally:
+            # stops the tile loaders, syncs the pack and saves the negative cache
+            widgets[-1].close()
     finally:
         pygame.display.quit()
-        running = False
-        t.join()
+        client.stop()
+        stats.close()
+
+
+def create_widgets(**map_args):
+    """
+    Build the dashboard widgets, the display must be set up first.
+
+    map_args are passed on to MapMaker, e.g. url=None for no tile source.
+    """
+    layer = StaticLayer(SCREEN_RESOLUTION)
+    side = AngleMeter("images/side_profile.png", (0, 0, 300, 300), layer=layer)
+    back = AngleMeter("images/back_profile.png", (0, 300, 300, 300), ratio=side.ratio, layer=layer)
+    speedometer = SpeedoMeter((0, 600, 300, 100), fmt="%4s", layer=layer)
+    altimeter = SpeedoMeter((0, 700, 300, 100), fmt="%4s", layer=layer)
+    # magnetometer = Compass("images/compass.png", (0, 200, 200, 200), layer=layer)
+    map = MapMaker((300, 0, 980, 800), cache_bytes=MAP_CACHE_BYTES, layer=layer,
+                   notify=scheduler.wake, assets=assets, **map_args)
+    map.set_heading_up(HEADING_UP)
+    return layer, side, back, speedometer, altimeter, map
+
+
+def render(screen, widgets, telemetry, E, N, level, force=False):
+    """
+    Draw one frame of the widgets from create_widgets() with the map centred at E, N.
+
+    telemetry holds the values named in FIELDS. Returns the damaged rectangles.
+    """
+    layer, side, back, speedometer, altimeter, map = widgets
+    azimuth, pitch, roll, speed, bearing, gps_east, gps_north, altitude = telemetry
+
+    if force:
+        screen.fill((0, 0, 0))
 
+    rects = []
+    rects += side.draw(screen, pitch, side.bg_color if -50 < pitch < 50 else side.warn_color, force=force)
+    rects += back.draw(screen, -roll, back.bg_color if -35 < roll < 35 else back.warn_color, force=force)
+    rects += speedometer.draw(screen, speed, speedometer.bg_color if speed < 80 else speedometer.warn_color,
+                              force=force)
+    rects += altimeter.draw(screen, altitude, altimeter.bg_color, force=force)
+    # magnetometer.draw(screen, (azimuth, (255, 0, 0)), (bearing, (0, 0, 255)))
 
-def main_loop():
-    global pitch, roll, speed, gps_east, gps_north, man_east, man_north, bearing, azimuth, altitude
+    stats.stage("meters")
 
-    screen = pygame.display.set_mode(SCREEN_RESOLUTION, pygame.FULLSCREEN)
-    pygame.mouse.set_cursor((8, 8), (0, 0), (0, 0, 0, 0, 0, 0, 0, 0), (0, 0, 0, 0, 0, 0, 0, 0))
-    # pygame.mouse.set_visible(False)
+    fovs = (azimuth, (255, 0, 0)), (bearing, (0, 0, 255))
+    rects += map.draw(screen, E, N, level, *fovs, force=force, heading=bearing)
+    # gps_bearing.draw(screen, bearing)
+    stats.stage("map")
+    return rects
 
-    clock = pygame.time.Clock()
 
-    side = AngleMeter("images/side_profile.png", (0, 0, 300, 300))
-    back = AngleMeter("images/back_profile.png", (0, 300, 300, 300), ratio=side.ratio)
-    speedometer = SpeedoMeter((0, 600, 300, 100), fmt="%4s")
-    altimeter = SpeedoMeter((0, 700, 300, 100), fmt="%4s")
-    # magnetometer = Compass("images/compass.png", (0, 200, 200, 200))
-    map = MapMaker((300, 0, 980, 800))
+def main_loop(screen, widgets):
+    global man_east, man_north
+
+    layer, side, back, speedometer, altimeter, map = widgets
     map_level = 4
+    prefetcher = Prefetcher(map)
 
     mouse_sx = mouse_sy = 0
     drag = mouse_dn = False
     centered = True
+    full_redraw = True
+    layer_generation = layer.generation
+    # test key edits, added to every snapshot drawn; the reader thread stays the only writer of telemetry
+    offsets = dict.fromkeys(("azimuth", "pitch", "roll", "speed", "bearing"), 0)
 
     while True:
-        clock.tick(20)
+        stats.start()
+        events = scheduler.wait()
+        stats.stage("idle")
+
+        # the reader thread may publish a newer snapshot at any time, draw this one
+        snapshot = telemetry
+        azimuth, pitch, roll, speed, bearing, gps_east, gps_north, altitude = snapshot
 
-        for event in pygame.event.get():
+        for event in events:
             if event.type is pygame.QUIT:
                 return
+            if event.type is pygame.VIDEOEXPOSE:
+                full_redraw = True
 
             if event.type is pygame.KEYDOWN and event.key == ord("+") and map_level < 10:
                 map_level += 1
             if event.type is pygame.KEYDOWN and event.key == ord("-") and map_level > 2:
                 map_level -= 1
+            if event.type is pygame.KEYDOWN and event.key == pygame.K_h:
+                map.set_heading_up(not map.heading_up)
+            if event.type is pygame.KEYDOWN and event.key == pygame.K_t:
+                stats.toggle()
+                full_redraw = True
 
             if event.type is pygame.MOUSEMOTION and mouse_dn:
                 if centered:
@@ -301,12 +509,16 @@ def main_loop():
         if key_pressed[pygame.K_ESCAPE]:
             return
 
+        if any(key_pressed):
+            # held keys repeat without events, keep rendering until released
+            scheduler.wake()
+
         if key_pressed[pygame.K_c]:
             centered = True
 
         if key_pressed[pygame.K_DOWN]:
             if pygame.key.get_mods() & pygame.KMOD_SHIFT:
-                pitch -= 1
+                offsets["pitch"] -= 1
             else:
                 if centered:
                     man_east = gps_east
@@ -316,7 +528,7 @@ def main_loop():
 
         if key_pressed[pygame.K_UP]:
             if pygame.key.get_mods() & pygame.KMOD_SHIFT:
-                pitch += 1
+                offsets["pitch"] += 1
             else:
                 if centered:
                     man_east = gps_east
@@ -326,7 +538,7 @@ def main_loop():
 
         if key_pressed[pygame.K_LEFT]:
             if pygame.key.get_mods() & pygame.KMOD_SHIFT:
-                roll -= 1
+                offsets["roll"] -= 1
             else:
                 if centered:
                     man_east = gps_east
@@ -336,7 +548,7 @@ def main_loop():
 
         if key_pressed[pygame.K_RIGHT]:
             if pygame.key.get_mods() & pygame.KMOD_SHIFT:
-                roll += 1
+                offsets["roll"] += 1
             else:
                 if centered:
                     man_east = gps_east
@@ -345,37 +557,49 @@ def main_loop():
                 man_east += map.get_step(map_level)
 
         if key_pressed[pygame.K_w]:
-            speed += 1
+            offsets["speed"] += 1
         if key_pressed[pygame.K_s]:
-            speed -= 1
+            offsets["speed"] -= 1
 
         if key_pressed[pygame.K_a]:
-            azimuth += 1
+            offsets["azimuth"] += 1
         if key_pressed[pygame.K_d]:
-            azimuth -= 1
+            offsets["azimuth"] -= 1
 
         if key_pressed[pygame.K_q]:
-            bearing += 1
+            offsets["bearing"] += 1
         if key_pressed[pygame.K_e]:
-            bearing -= 1
+            offsets["bearing"] -= 1
 
-        screen.fill((0, 0, 0))
-        side.draw(screen, pitch, side.bg_color if -50 < pitch < 50 else side.warn_color)
-        back.draw(screen, -roll, back.bg_color if -35 < roll < 35 else back.warn_color)
-        speedometer.draw(screen, speed, speedometer.bg_color if speed < 80 else speedometer.warn_color)
-        altimeter.draw(screen, altitude, altimeter.bg_color)
-        # magnetometer.draw(screen, (azimuth, (255, 0, 0)), (bearing, (0, 0, 255)))
+        if any(offsets.values()):
+            snapshot = snapshot.replace(**{name: getattr(snapshot, name) + offset for name, offset in offsets.items()})
+            azimuth, pitch, roll, speed, bearing, gps_east, gps_north, altitude = snapshot
+        values = tuple(snapshot)
 
+        stats.stage("input")
+
+        force = full_redraw or not DIRTY_RECTS
+        prefetcher.update(gps_east, gps_north, bearing, speed, map_level)
         if centered:
-            map.draw(screen, gps_east, gps_north, map_level)
+            rects = render(screen, widgets, values, gps_east, gps_north, map_level, force)
         else:
-            map.draw(screen, man_east, man_north, map_level)
-
-        map.draw_fov(screen, azimuth, (255, 0, 0))
-        map.draw_fov(screen, bearing, (0, 0, 255))
-        # gps_bearing.draw(screen, bearing)
-
-        pygame.display.flip()
+            rects = render(screen, widgets, values, man_east, man_north, map_level, force)
+
+        rects += stats.draw(screen, (map.rect.x + 10, map.rect.y + 10), get_font("fonts/munro.ttf", 20))
+
+        if force:
+            pygame.display.flip()
+            if scheduler.frames == 1:
+                print("first frame %.0f ms after start" % (1000 * (time.monotonic() - STARTED)))
+            full_redraw = False
+        elif rects:
+            pygame.display.update(rects)
+        stats.stage("flip")
+        stats.end(tiles=map.loaded, misses=map.tiles.misses, packets=snapshot.seq)
+
+        if layer.generation != layer_generation:
+            layer_generation = layer.generation
+            full_redraw = True
 
 
 if __name__ == "__main__":
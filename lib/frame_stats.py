@@ -0,0 +1,122 @@
+import time
+from collections import deque
+
+import pygame
+
+STAGES = ("idle", "input", "meters", "map", "flip")
+COUNTERS = ("tiles", "misses", "packets")
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+class FrameStats(object):
+    """
+    Per-stage timing of the main loop plus tile and telemetry counters.
+
+    Call start() at the top of a frame, stage(name) at the end of each stage
+    and end(**totals) with running totals of the counters in COUNTERS. The
+    last `window` frames are kept for the overlay; every frame is appended to
+    the CSV file `log` if one is given. Times are in milliseconds, counters are
+    per frame.
+    """
+
+    def __init__(self, window=200, log=None, refresh=0.5):
+        self.frames = deque(maxlen=window)
+        self.totals = None
+        self.t0 = self.mark = time.perf_counter()
+        self.record = {}
+
+        self.log = None
+        if log is not None:
+            self.log = open(log, "a", buffering=64 * 1024)
+            if self.log.tell() == 0:
+                self.log.write(",".join(("time", "frame") + STAGES + COUNTERS) + "\n")
+
+        self.visible = False
+        self.refresh = refresh
+        self.overlay = None
+        self.rendered = 0
+
+    def start(self):
+        self.t0 = self.mark = time.perf_counter()
+        self.record = {}
+
+    def stage(self, name):
+        now = time.perf_counter()
+        self.record[name] = self.record.get(name, 0) + 1000 * (now - self.mark)
+        self.mark = now
+
+    def end(self, **totals):
+        if self.totals is None:
+            self.totals = totals
+        for name in COUNTERS:
+            self.record[name] = totals.get(name, 0) - self.totals.get(name, 0)
+        self.totals = totals
+
+        self.record["frame"] = 1000 * (self.mark - self.t0)
+        self.frames.append(self.record)
+
+        if self.log is not None:
+            self.log.write("%.3f,%.2f,%s,%s\n" % (
+                time.time(), self.record["frame"], ",".join("%.2f" % self.record.get(name, 0) for name in STAGES),
+                ",".join("%d" % self.record[name] for name in COUNTERS)))
+
+    def percentiles(self, name, ps=(50, 95, 99)):
+        values = [frame.get(name, 0) for frame in self.frames]
+        return tuple(percentile(values, p) for p in ps) if values else (0,) * len(ps)
+
+    def seconds(self):
+        return sum(frame["frame"] for frame in self.frames) / 1000
+
+    def rate(self, name):
+        """
+        Events per second over the window, counting idle time.
+        """
+        seconds = self.seconds()
+        return sum(frame[name] for frame in self.frames) / seconds if seconds else 0
+
+    def lines(self):
+        lines = ["%-7s %6s %6s %6s" % ("ms", "p50", "p95", "p99")]
+        for name in ("frame",) + STAGES:
+            lines.append("%-7s %6.1f %6.1f %6.1f" % ((name,) + self.percentiles(name)))
+        seconds = self.seconds()
+        lines.append("fps %5.1f  tiles/s %5.1f" % (len(self.frames) / seconds if seconds else 0, self.rate("tiles")))
+        lines.append("misses/s %5.1f  packets/s %5.1f" % (self.rate("misses"), self.rate("packets")))
+        return lines
+
+    def toggle(self):
+        self.visible = not self.visible
+        self.overlay = None
+
+    def draw(self, surface, pos, font):
+        """
+        Draw the overlay at pos when visible, re-rendered every `refresh` seconds.
+
+        font is a (font, cell size) pair as returned by dashboard.get_font().
+        The font is proportional, so the overlay never shrinks while visible:
+        it must cover everything the previous one drew over the map.
+        """
+        if not self.visible:
+            return []
+
+        now = time.perf_counter()
+        if self.overlay is None or now - self.rendered >= self.refresh:
+            font, (_, height) = font
+            images = [font.render(line, False, (255, 255, 255)) for line in self.lines()]
+            size = max(image.get_width() for image in images) + 8, len(images) * height + 8
+            if self.overlay is not None:
+                size = max(size[0], self.overlay.get_width()), max(size[1], self.overlay.get_height())
+            self.overlay = pygame.Surface(size)
+            for i, image in enumerate(images):
+                self.overlay.blit(image, (4, 4 + i * height))
+            self.rendered = now
+
+        return [surface.blit(self.overlay, pos)]
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
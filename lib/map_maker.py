@@ -1,12 +1,16 @@
-import urllib.request
-
-import os
 import math
-from urllib.error import HTTPError
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import pygame
 
+from assets import AssetBundle
 from coordinates import WGS84lalo_to_ETRSTM35FINxy, Str_to_CoordinateValue
+from static_layer import StaticLayer
+from tile_cache import TileCache, NegativeCache
+from tile_loader import TileLoader
+from tile_pack import TilePack, FORMAT_PNG, decode_tile, encode_like
+from tile_source import HTTPTileSource, SourceOffline
 
 NORTH_BORDER = 7776640
 EAST_BORDER = 733330
@@ -18,24 +22,113 @@ SOUTH_BORDER = 6605100
 START_EAST = 20000
 START_NORTH = 6570000
 
+TILE_SIZE = {2: 240000, 3: 120000, 4: 48000, 5: 24000, 6: 12000, 7: 4800, 8: 2400, 9: 1200, 10: 480}
+TILE_URL = "http://tms.pikakartta.fi/maastokartta/%d/%d/%d.png"
+
+PREFETCH_PRIORITY = 1000000
+
 
 def WGS84_to_TM35FIN(la, lo):
     TM35FIN = WGS84lalo_to_ETRSTM35FINxy({"La": la, "Lo": lo})
     return round(TM35FIN['E']), round(TM35FIN['N'])
 
 
+def valid_tile(tile):
+    level, col, row = tile
+    size = TILE_SIZE[level]
+    e, n = START_EAST + col * size, START_NORTH + row * size
+
+    return e < EAST_BORDER and e + size > WEST_BORDER and n < NORTH_BORDER and n + size > SOUTH_BORDER
+
+
 class MapMaker(object):
-    def __init__(self, geometry, frame_color=(0x98, 0x6c, 0x6a)):
-        self.tiles = {}
+    def __init__(self, geometry, frame_color=(0x98, 0x6c, 0x6a), placeholder_color=(0x40, 0x40, 0x40), workers=4,
+                 cache_bytes=64 * 1024 * 1024, fallback_bytes=8 * 1024 * 1024, pack="maps.pack", url=TILE_URL,
+                 connections=2, max_age=30 * 24 * 3600, negative="maps.missing", layer=None,
+                 notify=None, heading_step=2, margin=120, rotate_interval=0.25, assets=None,
+                 rotate_in_background=True):
+        self.tiles = TileCache(cache_bytes)
+        self.fallbacks = TileCache(fallback_bytes)
+        self.pack = TilePack(pack)
+        self.source = HTTPTileSource(url, connections) if url else None
+        self.max_age = max_age
+        self.negative = NegativeCache(negative)
+        self.loader = TileLoader(self.load_tile, workers, notify)
+        self.prefetching = set()
+        # tiles that failed only because the source was offline, not asked for again until it is back
+        self.unreachable = set()
         self.frame_color = frame_color
         self.rect = pygame.Rect(*geometry)
+        self.layer = layer or StaticLayer(self.rect.bottomright)
         self.center = 384053, 6724400
 
-        self.crosshair = pygame.image.load("images/crosshair.png")
-        self.grey_map = pygame.image.load("images/grey_map.png")
+        assets = assets or AssetBundle()
+        self.crosshair = assets.image("images/crosshair.png", alpha=True)
+        self.grey_map = assets.image("images/grey_map.png")
+        self.placeholder = pygame.Surface((240, 240))
+        self.placeholder.fill(placeholder_color)
         self.crosshair_rect = (
             self.rect.centerx - self.crosshair.get_width() // 2, self.rect.centery - self.crosshair.get_height() // 2)
-        self.tile_size = {2: 240000, 3: 120000, 4: 48000, 5: 24000, 6: 12000, 7: 4800, 8: 2400, 9: 1200, 10: 480}
+
+        self.composite = self.make_composite(self.rect.size)
+        if pygame.display.get_surface() is not None:
+            self.placeholder = self.placeholder.convert()
+        self.origin = None
+        self.placeholders = set()
+        self.dirty = True
+        self.fovs = ()
+        self.tile_size = TILE_SIZE
+        self.loaded = 0
+
+        self.heading_up = False
+        self.heading_step = heading_step
+        self.margin = margin
+        self.rotate_interval = rotate_interval
+        self.angle = 0
+        self.rotated = None
+        self.rotated_key = None
+        self.rotated_at = 0
+        self.rotated_stale = False
+        self.notify = notify
+        self.rotator = ThreadPoolExecutor(1) if rotate_in_background else None
+        self.rotating = None
+
+    @staticmethod
+    def make_composite(size):
+        composite = pygame.Surface(size)
+        if pygame.display.get_surface() is not None:
+            composite = composite.convert()
+        return composite
+
+    def set_heading_up(self, enabled):
+        """
+        Switch between north-up and heading-up, where draw() rotates the map by the heading.
+
+        Heading-up needs a composite big enough to cover the rotated viewport, a
+        square of the viewport diagonal plus `margin` on each side. The margin
+        lets the last rotated image be reused while the map moves less than that.
+        """
+        if enabled == self.heading_up:
+            return
+
+        self.heading_up = enabled
+        if enabled:
+            side = 2 * (math.ceil(math.hypot(*self.rect.size) / 2) + self.margin)
+            self.composite = self.make_composite((side, side))
+        else:
+            self.composite = self.make_composite(self.rect.size)
+        # the next draw() composes everything, tiles still loading are not in the new composite
+        self.origin = None
+        self.placeholders = set()
+        self.rotated = None
+        self.rotating = None
+        self.dirty = True
+
+    def static_key(self):
+        return tuple(self.rect), self.frame_color
+
+    def draw_static(self, surface):
+        pygame.draw.rect(surface, self.frame_color, self.rect, 3)
 
     def get_step(self, level):
         return self.tile_size[level] // 10
@@ -45,11 +138,7 @@ class MapMaker(object):
         return mul * de, mul * dn
 
     def valid_tile(self, tile):
-        level, col, row = tile
-        size = self.tile_size[level]
-        e, n = self.tile_to_TM35FIN(tile)
-
-        return e < EAST_BORDER and e + size > WEST_BORDER and n < NORTH_BORDER and n + size > SOUTH_BORDER
+        return valid_tile(tile)
 
     def tile_to_TM35FIN(self, tile):
         level, col, row = tile
@@ -61,60 +150,380 @@ class MapMaker(object):
         return (E - START_EAST) // size, (N - START_NORTH) // size
 
     def tile_to_surface(self, tile):
+        """
+        Top left corner of the tile on the composite surface.
+        """
         level, col, row = tile
-        size = self.tile_size[level]
-        west, north = size * col + START_EAST, size * (row + 1) + START_NORTH
-        dE, dN = west - self.center[0], north - self.center[1]
-
-        x = self.rect.centerx + (dE // (size // 240))
-        y = self.rect.centery - (dN // (size // 240))
+        return col * 240 - self.origin[1], -(row + 1) * 240 - self.origin[2]
 
-        return x, y
-
-    def draw(self, surface, E, N, level):
-        self.center = E, N
+    def tile_range(self, E, N, level):
         size = self.tile_size[level]
-        area_width = self.rect.width * (size // 240)
+        width, height = self.composite.get_size()
+        area_width = width * (size // 240)
         east, west = E + (area_width // 2), E - (area_width // 2)
 
-        area_height = self.rect.height * (size // 240)
+        area_height = height * (size // 240)
         north, south = N + (area_height // 2), N - (area_height // 2)
 
-        start_tile = self.TM35FIN_to_tile(west, south, level)
-        end_tile = self.TM35FIN_to_tile(east, north, level)
+        return self.TM35FIN_to_tile(west, south, level), self.TM35FIN_to_tile(east, north, level)
 
-        for row in range(start_tile[1], end_tile[1] + 1):
-            for col in range(start_tile[0], end_tile[0] + 1):
-                self.draw_tile(surface, (level, col, row))
+    def close(self):
+        self.loader.stop()
+        if self.rotator is not None:
+            self.rotator.shutdown()
+        if self.source is not None:
+            self.source.close()
+        self.pack.close()
+        self.negative.save(force=True)
 
-        pygame.draw.rect(surface, self.frame_color, self.rect, 3)
+    def load_tile(self, tile):
+        """
+        Read a tile from the pack or the source, on a loader thread.
+
+        A failure of the tile, a download error as much as a tile that does
+        not decode, is recorded in the negative cache so draw() stops asking
+        for the tile until it has backed off. The cache is saved after every
+        change, a successful load clearing the tile included. A source that is
+        offline is not the fault of the tile, such tiles are only held back
+        until the source is back.
+        """
+        try:
+            entry = self.pack.get(tile, with_format=True)
+            if self.source is not None and (entry is None or self.stale(tile)):
+                entry = self.fetch_tile(tile, entry)
+            if entry is None:
+                # a 404 has been recorded as missing by fetch_tile
+                if self.source is None:
+                    self.negative.failed(tile)
+                return None
+            image = decode_tile(*entry)
+        except SourceOffline as e:
+            print("OFFLINE %d (%d, %d): %s" % (tile + (e,)))
+            self.unreachable.add(tile)
+            return None
+        except Exception as e:
+            print("FAILED %d (%d, %d): %s" % (tile + (e,)))
+            self.negative.failed(tile)
+            return None
+        else:
+            self.negative.clear(tile)
+            return image
+        finally:
+            self.negative.save()
+
+    def stale(self, tile):
+        """
+        Whether the tile was fetched more than max_age ago. A tile without a
+        fetch time came from an import and is taken as fresh.
+        """
+        meta = self.pack.get_meta(tile)
+        return meta is not None and time.time() - meta[0] > self.max_age
+
+    def fetch_tile(self, tile, entry):
+        """
+        Download a missing tile, or revalidate a stale one with its ETag and Last-Modified.
+
+        A stale tile is still returned when the source cannot be reached.
+        """
+        meta = self.pack.get_meta(tile) if entry is not None else None
+        etag, last_modified = meta[1:] if meta is not None else (None, None)
+        try:
+            response = self.source.fetch(tile, etag, last_modified)
+        except ConnectionError as e:
+            if entry is None:
+                raise
+            print("STALE %d (%d, %d): %s" % (tile + (e,)))
+            return entry
+
+        if response.status == 304:
+            self.pack.put_meta(tile, time.time(), response.etag or etag, response.last_modified or last_modified)
+            return entry
+        if response.status == 404:
+            if entry is None:
+                self.negative.missing(tile)
+            return entry
+
+        # keep a converted tile converted
+        entry = encode_like(response.data, entry) if entry is not None else (response.data, FORMAT_PNG)
+        self.pack.put(tile, *entry)
+        self.pack.put_meta(tile, time.time(), response.etag, response.last_modified)
+        print("WEB %d (%d, %d)" % tile)
+        return entry
+
+    def held(self, tile):
+        """
+        Whether the tile is not to be requested now, backing off in the negative cache or waiting for the source.
+        """
+        if self.negative.blocked(tile):
+            return True
+        if tile in self.unreachable:
+            if self.source is not None and self.source.offline():
+                return True
+            self.unreachable.discard(tile)
+        return False
+
+    def prefetch(self, tiles):
+        """
+        Queue tiles outside the viewport, in priority order, behind the visible ones.
+        """
+        self.prefetching = set()
+        for tile in tiles:
+            if self.valid_tile(tile) and tile not in self.tiles and not self.held(tile):
+                self.loader.request(tile, PREFETCH_PRIORITY + len(self.prefetching))
+                self.prefetching.add(tile)
+
+    def receive(self):
+        for tile, image in self.loader.poll():
+            if image is not None:
+                self.loaded += 1
+                self.tiles.put(tile, image)
+                self.fallbacks.discard(tile)
+            if tile in self.placeholders and self.origin is not None:
+                x, y = self.tile_to_surface(tile)
+                self.compose(pygame.Rect(x, y, 240, 240).clip(self.composite.get_rect()))
+                self.rotated_stale = True
+
+    def draw(self, surface, E, N, level, *fovs, force=False, heading=0):
+        """
+        Draw the map centred at E, N with the given (angle, color) field of view cones.
+
+        In heading-up mode the map is turned so that heading points up. The
+        angle follows the heading in steps of heading_step degrees, once it is
+        off by a whole step.
+
+        Returns the damaged rectangles, empty when nothing changed since the last call.
+        """
+        self.receive()
+
+        self.center = E, N
+        self.tiles.set_level(level)
+        self.fallbacks.set_level(level)
+
+        mpp = self.tile_size[level] // 240
+        width, height = self.composite.get_size()
+        x = (E - START_EAST) // mpp - width // 2
+        y = -((N - START_NORTH) // mpp) - height // 2
+
+        if self.origin is None or self.origin[0] != level \
+                or abs(self.origin[1] - x) >= width or abs(self.origin[2] - y) >= height:
+            self.origin = level, x, y
+            self.placeholders = set()
+            self.compose(self.composite.get_rect())
+
+        elif self.origin != (level, x, y):
+            dx, dy = self.origin[1] - x, self.origin[2] - y
+            self.origin = level, x, y
+            self.composite.scroll(dx, dy)
+
+            if dx > 0:
+                self.compose(pygame.Rect(0, 0, dx, height))
+            elif dx < 0:
+                self.compose(pygame.Rect(width + dx, 0, -dx, height))
+            if dy > 0:
+                self.compose(pygame.Rect(0, 0, width, dy))
+            elif dy < 0:
+                self.compose(pygame.Rect(0, height + dy, width, -dy))
+
+        start_tile, end_tile = self.tile_range(E, N, level)
+        visible = {(level, col, row)
+                   for row in range(start_tile[1], end_tile[1] + 1)
+                   for col in range(start_tile[0], end_tile[0] + 1)}
+        self.placeholders &= visible
+        center_col, center_row = self.TM35FIN_to_tile(E, N, level)
+        for tile in self.placeholders:
+            if not self.held(tile):
+                self.loader.request(tile, (tile[1] - center_col) ** 2 + (tile[2] - center_row) ** 2)
+        self.loader.retain(visible | self.prefetching)
+
+        angle = 0
+        if self.heading_up:
+            # hysteresis, so a bearing wobbling around a step boundary does not rotate every frame
+            angle = self.angle
+            if abs((heading - angle + 180) % 360 - 180) >= self.heading_step:
+                angle = round(heading / self.heading_step) * self.heading_step % 360
+        force = self.layer.update(self) or force
+        if not (self.dirty or force or fovs != self.fovs or angle != self.angle):
+            return []
+        self.dirty = False
+        self.fovs = fovs
+        self.angle = angle
+
+        inner = self.rect.inflate(-6, -6)
+        if force:
+            self.layer.restore(surface, self.rect)
+        if self.heading_up:
+            # the image on screen may still be at the previous angle while the new one is rotated
+            angle = self.draw_rotated(surface, inner)
+        else:
+            surface.blit(self.composite, inner, inner.move(-self.rect.x, -self.rect.y))
+        # the crosshair and cones lie on top of the tiles, so they cannot live in the static layer
+        # underneath; they are only redrawn along with the map, which is skipped on unchanged frames
         surface.blit(self.crosshair, self.crosshair_rect)
+        for fov, color in fovs:
+            self.draw_fov(surface, fov - angle, color)
+        return [self.rect]
 
-    def draw_tile(self, surface, tile):
+    def draw_rotated(self, surface, inner):
+        """
+        Draw the composite turned by self.angle, reusing the last rotated image when possible.
+
+        Only the part of the composite the viewport can see at the angle, plus
+        the margin, is rotated, and on the rotator thread. Until the new image
+        is ready the last one stays on screen, shifted by the rotated movement;
+        the angle of the image drawn is returned. A new rotation is started
+        when the angle changes, when new tiles have arrived, at most every
+        rotate_interval seconds, or when the map has moved half the margin.
+
+        When there is nothing usable to show, after a level change or a move
+        beyond the margin, just the viewport is rotated on the render thread,
+        which is much cheaper than the padded area, and the margin follows in
+        the background.
+        """
+        level, x, y = self.origin
+        now = time.monotonic()
+
+        if self.rotating is not None and self.rotating.done():
+            self.rotated, self.rotated_key = self.rotating.result()
+            self.rotating = None
+
+        def shift():
+            return x - self.rotated_key[2], y - self.rotated_key[3]
+
+        def unusable():
+            return self.rotated is None or self.rotated_key[1] != level \
+                or math.hypot(*shift()) > self.rotated_key[4]
+
+        if unusable() and self.rotating is not None:
+            self.rotated, self.rotated_key = self.rotating.result()
+            self.rotating = None
+
+        if unusable():
+            margin = 0 if self.rotator is not None else self.margin
+            self.rotated, self.rotated_key = self.rotate_area(*self.rotation_source(margin))
+            self.rotated_at = now
+            self.rotated_stale = False
+
+        angle, _, _, _, margin = self.rotated_key
+        if self.rotating is None and (angle != self.angle or margin < self.margin
+                                      or math.hypot(*shift()) > self.margin / 2
+                                      or self.rotated_stale and now - self.rotated_at >= self.rotate_interval):
+            source = self.rotation_source(self.margin)
+            if self.rotator is None:
+                self.rotated, self.rotated_key = self.rotate_area(*source)
+            else:
+                self.rotating = self.rotator.submit(self.rotate_area, *source)
+                if self.notify is not None:
+                    self.rotating.add_done_callback(lambda future: self.notify())
+            self.rotated_at = now
+            self.rotated_stale = False
+
+        # keep asking for frames until the new tiles and angle are on screen
+        self.dirty = self.rotated_stale or self.rotating is not None
+
+        angle = self.rotated_key[0]
+        dx, dy = shift()
+        a = math.radians(angle)
+        vx = dx * math.cos(a) + dy * math.sin(a)
+        vy = dy * math.cos(a) - dx * math.sin(a)
+        width, height = self.rotated.get_size()
+        pos = round(self.rect.centerx - width / 2 - vx), round(self.rect.centery - height / 2 - vy)
+
+        surface.set_clip(inner)
+        surface.blit(self.rotated, pos)
+        surface.set_clip(None)
+        return angle
+
+    def rotation_source(self, margin):
+        """
+        A copy of the centre of the composite the viewport covers at self.angle, plus margin, and its key.
+        """
+        a = math.radians(self.angle)
+        half_width, half_height = self.rect.width / 2, self.rect.height / 2
+        width = 2 * math.ceil(half_width * abs(math.cos(a)) + half_height * abs(math.sin(a)) + margin)
+        height = 2 * math.ceil(half_width * abs(math.sin(a)) + half_height * abs(math.cos(a)) + margin)
+        area = pygame.Rect(0, 0, width, height)
+        area.center = self.composite.get_rect().center
+        # copied on the render thread, compose() keeps drawing into the composite
+        source = self.composite.subsurface(area.clip(self.composite.get_rect())).copy()
+        return source, (self.angle,) + self.origin + (margin,)
+
+    @staticmethod
+    def rotate_area(source, key):
+        return pygame.transform.rotate(source, key[0]), key
+
+    def compose(self, area):
+        """
+        Redraw the tiles overlapping area of the composite surface.
+        """
+        level, x, y = self.origin
+        center_col, center_row = self.TM35FIN_to_tile(*self.center, level)
+        self.dirty = True
+
+        self.composite.set_clip(area)
+        for row in range(-((y + area.bottom - 1) // 240) - 1, -((y + area.top) // 240)):
+            for col in range((x + area.left) // 240, (x + area.right - 1) // 240 + 1):
+                self.draw_tile(self.composite, (level, col, row), (col - center_col) ** 2 + (row - center_row) ** 2)
+        self.composite.set_clip(None)
+
+    def draw_tile(self, surface, tile, priority=0):
         if self.valid_tile(tile):
-            if tile not in self.tiles:
-                try:
-                    if not os.path.isfile("maps/%d/%d/%d.png" % tile):
-                        image_url = "http://tms.pikakartta.fi/maastokartta/%d/%d/%d.png" % tile
-                        if not os.path.isdir("maps/%d/%d" % tile[:2]):
-                            os.makedirs("maps/%d/%d" % tile[:2])
-                        urllib.request.urlretrieve(image_url, "maps/%d/%d/%d.png" % tile)
-                        print("WEB %d (%d, %d)" % tile)
-                    self.tiles[tile] = pygame.image.load("maps/%d/%d/%d.png" % tile)
-                except HTTPError:
-                    pass
-
-            image = self.tiles[tile]
+            image = self.tiles.get(tile)
+            if image is None:
+                self.placeholders.add(tile)
+                if self.negative.blocked(tile):
+                    image = self.grey_map
+                else:
+                    if not self.held(tile):
+                        self.loader.request(tile, priority)
+                    image = self.fallback(tile) or self.placeholder
+            else:
+                self.placeholders.discard(tile)
 
         else:
             image = self.grey_map
 
-        tile_x, tile_y = self.tile_to_surface(tile)
-        x1 = max(self.rect.left - tile_x, 0)
-        y1 = max(self.rect.top - tile_y, 0)
-        w = min(tile_x + 240, self.rect.right) - max(tile_x, self.rect.left)
-        h = min(tile_y + 240, self.rect.bottom) - max(tile_y, self.rect.top)
-        surface.blit(image, (tile_x+x1, tile_y+y1), (x1, y1, w, h))
+        surface.blit(image, self.tile_to_surface(tile))
+
+    def fallback(self, tile):
+        """
+        Build a stand-in for a missing tile by scaling up the covering area of cached lower level tiles.
+
+        Levels N-1, N-2... are tried in turn until one has all the covering tiles
+        in memory. Results are kept in their own cache until the real tile arrives.
+        """
+        image = self.fallbacks.get(tile)
+        if image is not None:
+            return image
+
+        level = tile[0]
+        size = self.tile_size[level]
+        west, south = self.tile_to_TM35FIN(tile)
+
+        for parent_level in range(level - 1, min(self.tile_size) - 1, -1):
+            mpp = self.tile_size[parent_level] // 240
+            if size % mpp or size // mpp < 16:
+                break
+
+            start = self.TM35FIN_to_tile(west, south, parent_level)
+            end = self.TM35FIN_to_tile(west + size - 1, south + size - 1, parent_level)
+            parents = [(parent_level, col, row)
+                       for row in range(start[1], end[1] + 1)
+                       for col in range(start[0], end[0] + 1)]
+            if not all(parent in self.tiles or not self.valid_tile(parent) for parent in parents):
+                continue
+
+            area = pygame.Surface((size // mpp, size // mpp), 0, self.placeholder)
+            for parent in parents:
+                parent_west, parent_south = self.tile_to_TM35FIN(parent)
+                x = (parent_west - west) // mpp
+                y = (south - parent_south + size) // mpp - 240
+                area.blit(self.tiles.get(parent) if self.valid_tile(parent) else self.grey_map, (x, y))
+
+            image = pygame.transform.scale(area, (240, 240))
+            self.fallbacks.put(tile, image)
+            return image
+
+        return None
 
     def rotate(self, angle):
         """
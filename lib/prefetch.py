@@ -0,0 +1,66 @@
+import math
+import time
+
+
+class Prefetcher(object):
+    """
+    Warms the tile caches along the corridor ahead of the vehicle.
+
+    The position is projected forward along the bearing for `horizon` seconds
+    at the current speed, and the tiles of the viewport at each step are queued
+    on the map loader at the current zoom level and the levels next to it.
+    Faster driving means a longer corridor and more tiles queued per update.
+    """
+
+    def __init__(self, map, horizon=60, interval=1.0, min_speed=5, tiles_per_kmh=0.25, min_tiles=4):
+        self.map = map
+        self.horizon = horizon
+        self.interval = interval
+        self.min_speed = min_speed
+        self.tiles_per_kmh = tiles_per_kmh
+        self.min_tiles = min_tiles
+
+        self.last_update = 0
+
+    def update(self, E, N, bearing, speed, level):
+        now = time.monotonic()
+        if now - self.last_update < self.interval:
+            return
+        self.last_update = now
+
+        if speed < self.min_speed:
+            self.map.prefetch(())
+            return
+
+        budget = self.min_tiles + round(self.tiles_per_kmh * speed)
+        tiles = []
+        for lvl in (level, level + 1, level - 1):
+            if lvl in self.map.tile_size:
+                tiles += self.corridor(E, N, bearing, speed, lvl, budget)
+
+        self.map.prefetch(tiles)
+
+    def corridor(self, E, N, bearing, speed, level, budget):
+        size = self.map.tile_size[level]
+        distance = speed / 3.6 * self.horizon
+        dx, dy = math.sin(math.radians(bearing)), math.cos(math.radians(bearing))
+
+        tiles = []
+        seen = set()
+        steps = max(1, math.ceil(2 * distance / size))
+        for step in range(steps + 1):
+            d = distance * step / steps
+            start, end = self.map.tile_range(round(E + d * dx), round(N + d * dy), level)
+            for row in range(start[1], end[1] + 1):
+                for col in range(start[0], end[0] + 1):
+                    tile = (level, col, row)
+                    if tile in seen:
+                        continue
+                    seen.add(tile)
+
+                    if tile not in self.map.tiles:
+                        tiles.append(tile)
+                        if len(tiles) == budget:
+                            return tiles
+
+        return tiles
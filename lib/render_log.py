@@ -0,0 +1,152 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+
+import pygame
+
+import dashboard
+from frame_stats import percentile
+from telemetry import IMU_BATCH, OrientationFilter, is_recording, read_recording
+
+
+def read_log(path):
+    """
+    Yield (time, telemetry) from a log, telemetry in dashboard.FIELDS order.
+
+    A .csv log has a `time` column and one column per field. A recording made
+    with `sensor_tester.py --record` holds the frames as the phone sent them,
+    IMU batches are filtered like the dashboard does.
+    Anything else is read as JSON lines, either packets with an added `time`
+    or flat objects keyed like the CSV columns.
+    """
+    if is_recording(path):
+        snapshot = None
+        imu = OrientationFilter(dashboard.IMU_CUTOFF)
+        for t, kind, frame in read_recording(path):
+            if snapshot is None and kind == IMU_BATCH:
+                # angles without a position to draw them at yet
+                continue
+            snapshot = dashboard.update_telemetry(snapshot or dashboard.telemetry, kind, frame, imu, t)
+            yield t, tuple(snapshot)
+        return
+
+    with open(path, newline="") as f:
+        if path.endswith(".csv"):
+            for row in csv.DictReader(f):
+                yield float(row["time"]), tuple(float(row[name]) for name in dashboard.FIELDS)
+            return
+
+        for line in f:
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            if "location" in data:
+                yield data["time"], dashboard.parse_packet(data)
+            else:
+                yield data["time"], tuple(data[name] for name in dashboard.FIELDS)
+
+
+def resample(samples, fps):
+    """
+    The latest sample at every 1/fps seconds of log time, or every sample when fps is 0.
+    """
+    if not fps:
+        yield from samples
+        return
+
+    t = None
+    last = None
+    for sample in samples:
+        if t is None:
+            t = sample[0]
+        while last is not None and t < sample[0]:
+            yield t, last[1]
+            t += 1 / fps
+        last = sample
+    if last is not None:
+        yield t, last[1]
+
+
+def settle(map, timeout):
+    """
+    Wait up to timeout seconds for the visible tiles still loading, so frames show no placeholders.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and any(map.loader.is_loading(tile) for tile in map.placeholders):
+        time.sleep(0.005)
+        map.receive()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Render the dashboard offscreen from a telemetry log")
+    parser.add_argument("log", help="telemetry log, .csv, JSON lines or a recording")
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument("--png", help="PNG file name pattern, e.g. frames/%%06d.png")
+    output.add_argument("--raw", help="append raw RGB24 frames to this file")
+    parser.add_argument("--fps", type=float, default=20, help="frames per second of log time, 0 for every sample")
+    parser.add_argument("--level", type=int, default=8)
+    parser.add_argument("--heading-up", action="store_true")
+    parser.add_argument("--url", help="tile URL template instead of the dashboard's, empty for tiles in the pack only")
+    parser.add_argument("--wait-tiles", type=float, default=2, help="seconds to wait for visible tiles per frame")
+    parser.add_argument("--frames", type=int, help="stop after this many frames")
+    args = parser.parse_args(argv)
+
+    pygame.display.init()
+    pygame.font.init()
+    screen = pygame.display.set_mode(dashboard.SCREEN_RESOLUTION)
+
+    # every offscreen frame shows the heading and tiles of its own sample
+    map_args = dict(rotate_interval=0, rotate_in_background=False)
+    if args.url is not None:
+        # the source is chosen here, not swapped in afterwards leaving the default one open
+        map_args["url"] = args.url or None
+    widgets = dashboard.create_widgets(**map_args)
+    map = widgets[-1]
+    map.set_heading_up(args.heading_up)
+
+    raw = open(args.raw, "wb") if args.raw else None
+    times = []
+    start = time.perf_counter()
+    try:
+        for i, (t, telemetry) in enumerate(resample(read_log(args.log), args.fps)):
+            if args.frames is not None and i >= args.frames:
+                break
+
+            E, N = telemetry[5], telemetry[6]
+            if args.wait_tiles:
+                # a first draw asks for the tiles of the new position
+                map.draw(screen, E, N, args.level, heading=telemetry[4])
+                settle(map, args.wait_tiles)
+
+            t0 = time.perf_counter()
+            dashboard.render(screen, widgets, telemetry, E, N, args.level, force=i == 0)
+            times.append(time.perf_counter() - t0)
+
+            if args.png:
+                pygame.image.save(screen, args.png % i)
+            elif raw is not None:
+                raw.write(pygame.image.tobytes(screen, "RGB"))
+    finally:
+        if raw is not None:
+            raw.close()
+        map.close()
+    elapsed = time.perf_counter() - start
+
+    if not times:
+        sys.exit("no samples in %s" % args.log)
+
+    print("%d frames in %.1f s, %.1f frames/s, render p50 %.2f ms p95 %.2f ms p99 %.2f ms" % (
+        len(times), elapsed, len(times) / elapsed, 1000 * percentile(times, 50), 1000 * percentile(times, 95),
+        1000 * percentile(times, 99)))
+    if raw is not None:
+        print("ffmpeg -f rawvideo -pix_fmt rgb24 -s %dx%d -r %g -i %s trip.mp4" % (
+            screen.get_width(), screen.get_height(), args.fps or 20, args.raw))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,63 @@
+import time
+
+import pygame
+
+
+class RenderScheduler(object):
+    """
+    Decides when the main loop renders a frame.
+
+    Anything that changes the screen calls wake(), from any thread: a new
+    telemetry sample, a finished tile, held keys. Input events wake the
+    scheduler by themselves. A frame is rendered as soon as something woke the
+    scheduler, but at most max_fps times a second, and at least min_fps times a
+    second when nothing happens at all. In between the main loop sleeps in
+    pygame.event.wait(), so input is still picked up the moment it arrives.
+    """
+
+    def __init__(self, min_fps=1, max_fps=20, event_type=pygame.USEREVENT):
+        self.min_interval = 1 / max_fps
+        self.max_interval = 1 / min_fps
+        self.event_type = event_type
+
+        self.woken = False
+        self.dirty = True
+        self.last = 0
+        self.frames = 0
+
+    def wake(self):
+        if self.woken:
+            return
+        self.woken = True
+        try:
+            pygame.event.post(pygame.event.Event(self.event_type))
+        except pygame.error:
+            # display not up yet, the first frame is rendered regardless
+            self.woken = False
+
+    def wait(self):
+        """
+        Block until the next frame is due, returns the input events that arrived meanwhile.
+        """
+        events = []
+        while True:
+            now = time.monotonic()
+            if now >= self.last + (self.min_interval if self.dirty else self.max_interval):
+                break
+
+            timeout = self.last + (self.min_interval if self.dirty else self.max_interval) - now
+            event = pygame.event.wait(max(1, int(1000 * timeout)))
+            if event.type == pygame.NOEVENT:
+                continue
+
+            for event in [event] + pygame.event.get():
+                if event.type == self.event_type:
+                    self.woken = False
+                else:
+                    events.append(event)
+                self.dirty = True
+
+        self.last = now
+        self.dirty = False
+        self.frames += 1
+        return events
@@ -1,18 +1,47 @@
+import argparse
 import socket
+import sys
+import time
 
-# Create a TCP/IP socket
-sock = socket.socket()
-sock.connect(("192.168.43.1", 3451))
+from telemetry import BINARY, IMU_BATCH, PACKET, FrameBuffer, Recorder, decode_imu_batch, parse_address
 
-while True:
-    h = sock.recv(1)
-    l = sock.recv(1)
 
-    json_len = 256 * ord(h) + ord(l)
+def main(argv):
+    parser = argparse.ArgumentParser(description="Print or record the telemetry frames of the phone")
+    parser.add_argument("source", nargs="?", default="192.168.43.1:3451", type=parse_address, help="host:port")
+    parser.add_argument("--record", help="write the frames with their receive times into this file")
+    args = parser.parse_args(argv)
 
-    json = bytes()
-    while len(json) < json_len:
-        json += sock.recv(json_len - len(json))
+    # Create a TCP/IP socket
+    sock = socket.socket()
+    sock.connect(args.source)
 
-    print(json)
+    recorder = Recorder(args.record) if args.record else None
+    frames = FrameBuffer()
+    try:
+        while True:
+            frames.recv_into(sock)
+            # frames that arrived in one read share its timestamp
+            t = time.perf_counter_ns()
+            for kind, frame in frames.frames():
+                if recorder is not None:
+                    recorder.write(frame, t, kind)
+                elif kind == BINARY:
+                    print(PACKET.unpack(frame))
+                elif kind == IMU_BATCH:
+                    start, offsets, azimuth, pitch, roll = decode_imu_batch(frame)
+                    print("IMU %.3f: %d samples, pitch %.1f..%.1f, roll %.1f..%.1f" % (
+                        start, len(offsets), min(pitch), max(pitch), min(roll), max(roll)))
+                else:
+                    print(bytes(frame))
+    except (KeyboardInterrupt, ConnectionError):
+        pass
+    finally:
+        sock.close()
+        if recorder is not None:
+            recorder.close()
+            print("recorded %d frames into %s" % (recorder.count, args.record))
 
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,43 @@
+import pygame
+
+
+class StaticLayer(object):
+    """
+    Screen-sized surface holding the parts of widgets that only change with their layout or colours.
+
+    A widget provides static_key(*args), whose first item is its rectangle, and
+    draw_static(surface, *args). The static part of a widget is redrawn into
+    the layer whenever its key changes. If a widget moves, the whole layer is
+    cleared and `generation` is bumped so the caller knows to repaint the screen.
+    """
+
+    def __init__(self, size, color=(0, 0, 0)):
+        self.color = color
+        self.surface = pygame.Surface(size)
+        if pygame.display.get_surface() is not None:
+            self.surface = self.surface.convert()
+        self.surface.fill(color)
+
+        self.keys = {}
+        self.generation = 0
+
+    def update(self, widget, *args):
+        """
+        Bring the static part of widget up to date, returns True if it was redrawn.
+        """
+        key = widget.static_key(*args)
+        old = self.keys.get(widget)
+        if old == key:
+            return False
+
+        if old is not None and old[0] != key[0]:
+            self.surface.fill(self.color)
+            self.keys = {}
+            self.generation += 1
+
+        self.keys[widget] = key
+        widget.draw_static(self.surface, *args)
+        return True
+
+    def restore(self, surface, rect):
+        surface.blit(self.surface, rect, rect)
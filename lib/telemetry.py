@@ -0,0 +1,658 @@
+import argparse
+import asyncio
+import json
+import math
+import random
+import struct
+import sys
+import threading
+import time
+from array import array
+
+# big-endian frame length in front of every frame, its top two bits the kind of frame
+HEADER = struct.Struct(">H")
+JSON = 0
+BINARY = 0x8000
+IMU_BATCH = 0xc000
+KINDS = 0xc000
+MAX_LENGTH = 0x3fff
+
+# a binary packet: the phone's values in PACKET_FIELDS order, little-endian
+PACKET = struct.Struct("<3f2d3f")
+PACKET_FIELDS = ("azimuth", "pitch", "roll", "latitude", "longitude", "speed", "bearing", "altitude")
+
+# an IMU batch: phone time of the batch, then samples of seconds after it, azimuth, pitch and roll
+IMU_HEADER = struct.Struct("<d")
+IMU_SAMPLE = struct.Struct("<4f")
+
+# recordings: magic, then every frame as nanoseconds since the first frame, frame header and data
+RECORDING_MAGIC = b"TELEMREC\x01"
+RECORD = struct.Struct("<QH")
+
+FIELDS = ("azimuth", "pitch", "roll", "speed", "bearing", "gps_east", "gps_north", "altitude")
+
+
+async def read_frame(reader):
+    """
+    The next frame as (kind, data), kind one of JSON, BINARY and IMU_BATCH.
+    """
+    header = await reader.readexactly(HEADER.size)
+    length, = HEADER.unpack(header)
+    return check_kind(length & KINDS), await reader.readexactly(length & MAX_LENGTH)
+
+
+def check_kind(kind):
+    """
+    Raise ConnectionError for a kind of frame this reader does not know.
+
+    Its length may mean something else too, so the rest of the stream cannot
+    be trusted; the connection has to be dropped.
+    """
+    if kind not in (JSON, BINARY, IMU_BATCH):
+        raise ConnectionError("unknown frame kind 0x%04x" % kind)
+    return kind
+
+
+def encode_frame(data, kind=JSON):
+    if len(data) > MAX_LENGTH:
+        raise ValueError("frame of %d bytes, at most %d fit" % (len(data), MAX_LENGTH))
+    return HEADER.pack(len(data) | kind) + data
+
+
+def pack_packet(packet):
+    """
+    The binary packet for a decoded JSON packet.
+    """
+    angles = packet["orientation_angles"]
+    loc = packet["location"]
+    return PACKET.pack(angles["azimuth"], angles["pitch"], angles["roll"], loc["latitude"], loc["longitude"],
+                       loc["speed"], loc["bearing"], loc["altitude"])
+
+
+def pack_imu_batch(start, samples):
+    """
+    The IMU batch for (seconds after start, azimuth, pitch, roll) samples.
+    """
+    return IMU_HEADER.pack(start) + b"".join(IMU_SAMPLE.pack(*sample) for sample in samples)
+
+
+def decode_imu_batch(data):
+    """
+    The start time and arrays of the offsets, azimuths, pitches and rolls of an IMU batch.
+
+    The samples are read with one frombytes() however many there are, and
+    split into columns by slicing, so a batch costs about as much to decode
+    as a single packet.
+    """
+    if len(data) < IMU_HEADER.size:
+        raise ValueError("IMU batch of %d bytes, shorter than its header" % len(data))
+    start, = IMU_HEADER.unpack_from(data)
+    samples = array("f")
+    samples.frombytes(data[IMU_HEADER.size:len(data) - (len(data) - IMU_HEADER.size) % IMU_SAMPLE.size])
+    if sys.byteorder == "big":
+        samples.byteswap()
+    return start, samples[0::4], samples[1::4], samples[2::4], samples[3::4]
+
+
+class FrameBuffer(object):
+    """
+    Reassembles length-prefixed frames from a blocking socket in one reusable bytearray.
+
+    recv_into() reads straight into the free end of the buffer, and frames()
+    then yields (kind, memoryview) for every complete frame received,
+    however many arrived in one read. The views point into the buffer and are
+    only valid until the next recv_into(); take bytes(frame) to keep one.
+    get_buffer() and buffer_updated() are the same read split in two, for
+    FrameProtocol.
+    """
+
+    def __init__(self, size=256 * 1024):
+        # room for a whole frame after any partial one
+        size = max(size, 2 * (HEADER.size + MAX_LENGTH))
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def get_buffer(self):
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif len(self.buffer) - self.end < HEADER.size + MAX_LENGTH:
+            # move the partial frame to the front, the only copy a byte ever gets
+            pending = self.end - self.start
+            self.view[:pending] = self.view[self.start:self.end]
+            self.start, self.end = 0, pending
+        return self.view[self.end:]
+
+    def buffer_updated(self, n):
+        self.end += n
+
+    def recv_into(self, sock):
+        n = sock.recv_into(self.get_buffer())
+        if not n:
+            raise ConnectionError("socket closed")
+        self.buffer_updated(n)
+        return n
+
+    def frames(self):
+        buffer = self.buffer
+        while self.end - self.start >= HEADER.size:
+            kind = check_kind(buffer[self.start] << 8 & KINDS)
+            length = (buffer[self.start] & 0x3f) << 8 | buffer[self.start + 1]
+            start = self.start + HEADER.size
+            if self.end - start < length:
+                break
+            self.start = start + length
+            yield kind, self.view[start:self.start]
+
+
+class FrameProtocol(asyncio.BufferedProtocol):
+    """
+    Feeds a FrameBuffer from an asyncio connection and calls on_frame(kind, data) for every frame.
+
+    The transport reads straight into the FrameBuffer, so frames are never
+    copied; data is a memoryview that is only valid during the call.
+    `closed` is a future that gets the error the connection ended with, or
+    None, and `received` counts the bytes read, for a read timeout.
+    """
+
+    def __init__(self, on_frame):
+        self.on_frame = on_frame
+        self.frames = FrameBuffer()
+        self.transport = None
+        self.closed = asyncio.get_running_loop().create_future()
+        self.received = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        return self.frames.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        self.frames.buffer_updated(nbytes)
+        self.received += nbytes
+        try:
+            for kind, frame in self.frames.frames():
+                self.on_frame(kind, frame)
+        except ConnectionError as e:
+            self.close(e)
+
+    def connection_lost(self, exc):
+        self.close(exc or ConnectionError("connection closed"))
+
+    def close(self, exc):
+        if not self.closed.done():
+            self.closed.set_result(exc)
+        self.transport.abort()
+
+
+class Recorder(object):
+    """
+    Writes frames with their receive times into a recording, see read_recording().
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "wb")
+        self.file.write(RECORDING_MAGIC)
+        self.start = None
+        self.count = 0
+
+    def write(self, frame, t=None, kind=JSON):
+        """
+        Append one frame, t is its time.perf_counter_ns() and defaults to now.
+        """
+        t = time.perf_counter_ns() if t is None else t
+        if self.start is None:
+            self.start = t
+        self.file.write(RECORD.pack(t - self.start, len(frame) | kind))
+        self.file.write(frame)
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+
+
+def is_recording(path):
+    with open(path, "rb") as f:
+        return f.read(len(RECORDING_MAGIC)) == RECORDING_MAGIC
+
+
+def read_recording(path):
+    """
+    Yield (seconds since the first frame, kind, frame) from a recording; a frame cut short at the end is dropped.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(RECORDING_MAGIC)) != RECORDING_MAGIC:
+            raise ValueError("%s: not a telemetry recording" % path)
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            t, length = RECORD.unpack(header)
+            frame = f.read(length & MAX_LENGTH)
+            if len(frame) < length & MAX_LENGTH:
+                return
+            yield t / 1e9, length & KINDS, frame
+
+
+class TelemetrySnapshot(object):
+    """
+    One telemetry sample with the values in FIELDS order, its sequence number and receive time.
+
+    Snapshots are immutable, so the reader thread publishes a sample by
+    swapping a single reference and the render thread never sees values from
+    two different packets. Iterating yields the values in FIELDS order.
+    """
+
+    __slots__ = FIELDS + ("seq", "timestamp")
+
+    def __init__(self, values, seq=0, timestamp=0.0):
+        if len(values) != len(FIELDS):
+            raise ValueError("expected %d values, got %d" % (len(FIELDS), len(values)))
+        for name, value in zip(FIELDS, values):
+            object.__setattr__(self, name, value)
+        object.__setattr__(self, "seq", seq)
+        object.__setattr__(self, "timestamp", timestamp)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("TelemetrySnapshot is immutable")
+
+    def __iter__(self):
+        return (getattr(self, name) for name in FIELDS)
+
+    def replace(self, **values):
+        """
+        A copy with some values changed, keeping seq and timestamp.
+        """
+        return TelemetrySnapshot(tuple(values.pop(name, getattr(self, name)) for name in FIELDS),
+                                 self.seq, self.timestamp)
+
+    def __repr__(self):
+        return "TelemetrySnapshot(%s, seq=%d, timestamp=%.3f)" % (tuple(self), self.seq, self.timestamp)
+
+
+class TelemetryHistory(object):
+    """
+    Ring buffer of the last `size` snapshots, one preallocated array of doubles per field.
+
+    One thread appends, any thread reads without locks. append() fills the
+    slot before it bumps `count`, so a reader sees only whole samples. A
+    reader that was overtaken by the writer drops the overwritten samples
+    instead of returning a mix of old and new.
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.columns = {name: array("d", bytes(8 * size)) for name in FIELDS + ("timestamp",)}
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def append(self, snapshot):
+        i = self.count % self.size
+        for name, column in self.columns.items():
+            column[i] = getattr(snapshot, name)
+        self.count += 1
+
+    def values(self, name, n):
+        """
+        Up to the last n values of a field, oldest first, as an array.
+        """
+        return self.read((name,), n)[0]
+
+    def window(self, name, seconds, now=None):
+        """
+        Values of a field received in the last `seconds`, oldest first.
+        """
+        now = time.monotonic() if now is None else now
+        values, timestamps = self.read((name, "timestamp"), self.size)
+        for i, t in enumerate(timestamps):
+            if t >= now - seconds:
+                return values[i:]
+        return array("d")
+
+    def read(self, names, n):
+        """
+        The last n values of several fields as arrays covering the same samples.
+        """
+        count = self.count
+        first = count - min(n, count, self.size)
+        start, end = first % self.size, count % self.size
+
+        arrays = []
+        for name in names:
+            column = self.columns[name]
+            if first == count:
+                arrays.append(array("d"))
+            elif start < end:
+                arrays.append(column[start:end])
+            else:
+                arrays.append(column[start:] + column[:end])
+
+        # the writer may be overwriting the oldest slot, or have overwritten more while they were copied
+        lost = self.count - self.size + 1 - first
+        return [values[lost:] for values in arrays] if lost > 0 else arrays
+
+
+class OrientationFilter(object):
+    """
+    First-order low-pass filter over batches of orientation samples, decimated to one value per batch.
+
+    update() runs every sample of a batch through the filter with the
+    sample's own time step, so the result does not depend on how the phone
+    batched them, and returns only the latest filtered angles for the next
+    frame to draw. Angles are filtered the short way round the circle and
+    come out in [-180, 180). A cutoff of a few Hz keeps the vibration out
+    with a delay of about 1 / (2 pi cutoff) seconds.
+    """
+
+    def __init__(self, cutoff=4.0):
+        self.tau = 1 / (2 * math.pi * cutoff)
+        self.state = None
+        self.last = None
+        self.updated = None
+
+    def update(self, start, offsets, channels, now=None):
+        """
+        Filter a batch from decode_imu_batch() and return the latest angles, one per channel.
+        """
+        if not len(offsets):
+            return self.state
+
+        # the smoothing factor of every sample, from its own time step
+        last = start + offsets[0] if self.last is None else self.last
+        alphas = []
+        for offset in offsets:
+            dt = max(start + offset - last, 0)
+            alphas.append(dt / (self.tau + dt))
+            last = start + offset
+        self.last = last
+
+        state = self.state or [column[0] for column in channels]
+        for j, column in enumerate(channels):
+            value = state[j]
+            for x, alpha in zip(column, alphas):
+                value += alpha * ((x - value + 180) % 360 - 180)
+            state[j] = (value + 180) % 360 - 180
+        self.state = state
+        self.updated = time.monotonic() if now is None else now
+        return self.state
+
+
+class TelemetryClient(object):
+    """
+    Reads length-prefixed telemetry frames from one or more sources on an asyncio loop in its own thread.
+
+    Every frame is handed to on_frame(source, kind, data) on the client
+    thread, data a memoryview into the receive buffer that is only valid
+    during the call.
+    A source that fails to connect, closes or goes quiet for read_timeout
+    seconds is reconnected after an exponential backoff with jitter, so
+    several dashboards do not hammer a phone in lockstep. stop() closes the
+    connections and joins the thread.
+    """
+
+    def __init__(self, sources, on_frame, backoff=0.5, max_backoff=30, connect_timeout=5, read_timeout=10):
+        self.sources = sources
+        self.on_frame = on_frame
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+        self.loop = None
+        self.stopping = None
+        self.thread = None
+        self.frames = 0
+
+    def start(self):
+        ready = threading.Event()
+        self.thread = threading.Thread(target=lambda: asyncio.run(self.run(ready)), daemon=True)
+        self.thread.start()
+        ready.wait()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.loop.call_soon_threadsafe(self.stopping.set)
+        self.thread.join()
+        self.thread = None
+
+    async def run(self, ready=None):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        if ready is not None:
+            ready.set()
+
+        tasks = [asyncio.create_task(self.read_source(host, port)) for host, port in self.sources]
+        await self.stopping.wait()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def delay(self, failures):
+        delay = min(self.max_backoff, self.backoff * 2 ** failures)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def deliver(self, source, kind, data):
+        self.frames += 1
+        try:
+            self.on_frame(source, kind, data)
+        except (ValueError, KeyError, TypeError, struct.error) as e:
+            print("TELEMETRY %s:%d bad frame: %r" % (source + (e,)))
+
+    async def read_source(self, host, port):
+        failures = 0
+        while True:
+            transport = None
+            try:
+                transport, protocol = await asyncio.wait_for(self.loop.create_connection(
+                    lambda: FrameProtocol(lambda kind, data: self.deliver((host, port), kind, data)), host, port),
+                    self.connect_timeout)
+                print("TELEMETRY connected to %s:%d" % (host, port))
+                failures = 0
+
+                while not protocol.closed.done():
+                    received = protocol.received
+                    await asyncio.wait([protocol.closed], timeout=self.read_timeout)
+                    if protocol.received == received and not protocol.closed.done():
+                        raise asyncio.TimeoutError()
+                raise protocol.closed.result()
+
+            except (OSError, asyncio.TimeoutError) as e:
+                delay = self.delay(failures)
+                failures += 1
+                print("TELEMETRY %s:%d %s, retrying in %.1f s" % (host, port, str(e) or type(e).__name__, delay))
+            finally:
+                if transport is not None:
+                    transport.abort()
+
+            await asyncio.sleep(delay)
+
+
+def synthetic_orientation(t):
+    """
+    Azimuth, pitch and roll for a drive around a 500 m circle, t in seconds.
+    """
+    return (t * 6) % 360, 15 * math.sin(t / 3), 10 * math.cos(t / 5)
+
+
+def synthetic_packet(t):
+    """
+    A phone packet for a drive around a 500 m circle, t in seconds.
+    """
+    bearing, pitch, roll = synthetic_orientation(t)
+    return {
+        "orientation_angles": {"azimuth": round(bearing), "pitch": round(pitch), "roll": round(roll)},
+        "location": {"latitude": 60.62 + 0.0045 * math.sin(math.radians(bearing)),
+                     "longitude": 24.0 - 0.009 * math.cos(math.radians(bearing)),
+                     "speed": 52 / 3.6, "bearing": bearing, "altitude": 100 + 5 * math.sin(t / 10)},
+    }
+
+
+class TelemetryServer(object):
+    """
+    Local stand-in for the phone, sends synthetic packets at a fixed rate to every client, JSON or binary.
+
+    With an imu_rate every packet is followed by an IMU batch of the
+    orientation samples since the previous one. Subclasses send something
+    else by overriding packets().
+    """
+
+    def __init__(self, host="127.0.0.1", port=3451, rate=20, binary=False, imu_rate=0):
+        self.host = host
+        self.port = port
+        self.rate = rate
+        self.binary = binary
+        self.imu_rate = imu_rate
+        self.server = None
+
+    def packets(self):
+        """
+        Yield (seconds after the client connected, encoded frame) for one client.
+        """
+        for i in range(sys.maxsize):
+            t = i / self.rate
+            packet = synthetic_packet(t)
+            if self.binary:
+                yield t, encode_frame(pack_packet(packet), BINARY)
+            else:
+                yield t, encode_frame(json.dumps(packet).encode("utf-8"))
+            if self.imu_rate and i:
+                yield t, encode_frame(pack_imu_batch(t - 1 / self.rate, self.imu_samples(t - 1 / self.rate)),
+                                      IMU_BATCH)
+
+    def imu_samples(self, start):
+        """
+        The orientation samples of one packet interval from start, with some road vibration on pitch and roll.
+        """
+        for k in range(max(1, round(self.imu_rate / self.rate))):
+            azimuth, pitch, roll = synthetic_orientation(start + k / self.imu_rate)
+            yield k / self.imu_rate, azimuth, pitch + random.gauss(0, 2), roll + random.gauss(0, 2)
+
+    async def handle(self, reader, writer):
+        start = time.monotonic()
+        count = 0
+        try:
+            for t, frame in self.packets():
+                delay = start + t - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                elif count % 64 == 0:
+                    # drain() does not yield until the socket buffer fills, let the other clients have a turn
+                    await asyncio.sleep(0)
+                writer.write(frame)
+                await writer.drain()
+                count += 1
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            writer.close()
+        elapsed = time.monotonic() - start
+        print("sent %d frames in %.1f s, %.0f frames/s" % (count, elapsed, count / max(elapsed, 1e-9)))
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.server
+
+    async def serve_forever(self):
+        server = await self.start()
+        print("serving %s telemetry on %s:%d at %g packets/s%s" % (
+            "binary" if self.binary else "JSON", self.host, self.port, self.rate,
+            ", %g IMU samples/s" % self.imu_rate if self.imu_rate else ""))
+        async with server:
+            await server.serve_forever()
+
+
+class ReplayServer(TelemetryServer):
+    """
+    Sends a recording to every client at its recorded pace times speed, or as fast as possible when speed is 0.
+    """
+
+    def __init__(self, path, host="127.0.0.1", port=3451, speed=1.0, loop=False):
+        super().__init__(host, port)
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        # read once, every client gets the whole recording
+        self.frames = [(t, encode_frame(data, kind)) for t, kind, data in read_recording(path)]
+        if not self.frames:
+            raise ValueError("%s: empty recording" % path)
+        self.duration = self.frames[-1][0]
+
+    def packets(self):
+        offset = 0
+        while True:
+            for t, frame in self.frames:
+                yield (offset + t) / self.speed if self.speed else 0, frame
+            if not self.loop:
+                return
+            # one mean frame interval between the last frame and the first again
+            offset += self.duration + self.duration / max(len(self.frames) - 1, 1)
+
+    async def serve_forever(self):
+        server = await self.start()
+        print("replaying %d frames, %.1f s of %s on %s:%d at %s" % (
+            len(self.frames), self.duration, self.path, self.host, self.port,
+            "%gx" % self.speed if self.speed else "full speed"))
+        async with server:
+            await server.serve_forever()
+
+
+def parse_address(text):
+    host, _, port = text.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Telemetry stand-in server and client")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("serve", help="send synthetic phone packets")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=3451)
+    p.add_argument("--rate", type=float, default=20, help="packets per second")
+    p.add_argument("--binary", action="store_true", help="send binary packets instead of JSON")
+    p.add_argument("--imu-rate", type=float, default=0, help="also send batches of this many IMU samples per second")
+
+    p = commands.add_parser("replay", help="send a recording made with sensor_tester.py --record")
+    p.add_argument("recording")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=3451)
+    p.add_argument("--speed", type=float, default=1, help="multiple of the recorded pace, 0 for as fast as possible")
+    p.add_argument("--loop", action="store_true", help="start over at the end")
+
+    p = commands.add_parser("read", help="print the packet rate of one or more sources")
+    p.add_argument("sources", nargs="+", type=parse_address, help="host:port")
+    p.add_argument("--seconds", type=float, default=10)
+
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        try:
+            asyncio.run(TelemetryServer(args.host, args.port, args.rate, args.binary, args.imu_rate).serve_forever())
+        except KeyboardInterrupt:
+            pass
+
+    elif args.command == "replay":
+        try:
+            asyncio.run(ReplayServer(args.recording, args.host, args.port, args.speed, args.loop).serve_forever())
+        except KeyboardInterrupt:
+            pass
+
+    elif args.command == "read":
+        client = TelemetryClient(args.sources, lambda source, kind, data: None)
+        client.start()
+        try:
+            time.sleep(args.seconds)
+        except KeyboardInterrupt:
+            pass
+        client.stop()
+        print("%d frames, %.1f frames/s" % (client.frames, client.frames / args.seconds))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
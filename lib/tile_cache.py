@@ -0,0 +1,165 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def surface_bytes(surface):
+    return surface.get_pitch() * surface.get_height()
+
+
+class TileCache(object):
+    """
+    LRU cache of decoded tile surfaces bounded by a byte budget.
+
+    When over budget the oldest `window` entries are considered and the one
+    farthest from the current zoom level is evicted first, oldest on ties.
+    The most recently used tile is never evicted.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, window=8):
+        self.max_bytes = max_bytes
+        self.window = window
+        self.level = None
+
+        self.entries = OrderedDict()
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, tile):
+        return tile in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, tile):
+        entry = self.entries.get(tile)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(tile)
+        return entry[0]
+
+    def put(self, tile, surface):
+        self.discard(tile)
+
+        size = surface_bytes(surface)
+        self.entries[tile] = surface, size
+        self.bytes += size
+
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            self.evict()
+
+    def discard(self, tile):
+        entry = self.entries.pop(tile, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def set_level(self, level):
+        self.level = level
+
+    def evict(self):
+        victim = None
+        victim_distance = -1
+        last = min(self.window, len(self.entries) - 1)
+        for i, tile in enumerate(self.entries):
+            if i == last:
+                break
+            distance = 0 if self.level is None else abs(tile[0] - self.level)
+            if distance > victim_distance:
+                victim, victim_distance = tile, distance
+
+        self.discard(victim)
+        self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "tiles": len(self.entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class NegativeCache(object):
+    """
+    Remembers tiles that are missing on the server or failed to load.
+
+    Missing tiles (404) are not asked for again for `missing_ttl` seconds.
+    Failed tiles are retried with exponential backoff. Entries are saved to
+    `path` as JSON, at most every `save_interval` seconds, so they survive
+    restarts.
+    """
+
+    def __init__(self, path, missing_ttl=7 * 24 * 3600, backoff=5, max_backoff=3600, save_interval=30):
+        self.path = path
+        self.missing_ttl = missing_ttl
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.save_interval = save_interval
+
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.dirty = False
+        self.saved = 0
+
+        if path and os.path.isfile(path):
+            try:
+                with open(path) as f:
+                    for key, entry in json.load(f).items():
+                        self.entries[tuple(int(x) for x in key.split("/"))] = tuple(entry)
+            except (OSError, ValueError) as e:
+                print("NEGATIVE %s: %s" % (path, e))
+
+    def __contains__(self, tile):
+        return tile in self.entries
+
+    def blocked(self, tile):
+        entry = self.entries.get(tile)
+        return entry is not None and time.time() < entry[1]
+
+    def missing(self, tile):
+        with self.lock:
+            failures = self.entries.get(tile, (0,))[0] + 1
+            self.entries[tile] = failures, time.time() + self.missing_ttl, True
+            self.dirty = True
+
+    def failed(self, tile):
+        with self.lock:
+            failures = self.entries.get(tile, (0,))[0] + 1
+            delay = min(self.backoff * 2 ** (failures - 1), self.max_backoff)
+            self.entries[tile] = failures, time.time() + delay, False
+            self.dirty = True
+
+    def clear(self, tile):
+        if tile in self.entries:
+            with self.lock:
+                self.entries.pop(tile, None)
+                self.dirty = True
+
+    def save(self, force=False):
+        with self.lock:
+            if not self.path or not self.dirty or (not force and time.time() - self.saved < self.save_interval):
+                return
+
+            expired = time.time() - self.max_backoff
+            data = {"%d/%d/%d" % tile: entry for tile, entry in self.entries.items() if entry[1] > expired}
+            self.dirty = False
+            self.saved = time.time()
+
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
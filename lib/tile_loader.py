@@ -0,0 +1,96 @@
+import heapq
+import itertools
+import threading
+
+
+class TileLoader(object):
+    """
+    Background worker pool for map tiles.
+
+    Requests are served nearest-first by priority. Requests that are no longer
+    wanted (panned or zoomed out of view) are dropped with retain() before a
+    worker picks them up. Finished tiles are collected with poll() from the
+    render thread, which can ask to be woken up with `notify`.
+    """
+
+    def __init__(self, load, workers=4, notify=None):
+        self.load = load
+        self.notify = notify
+
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+        self.queue = []
+        self.pending = {}
+        self.in_flight = set()
+        self.done = []
+        self.counter = itertools.count()
+        self.running = True
+
+        self.threads = [threading.Thread(target=self.worker, daemon=True) for _ in range(workers)]
+        for t in self.threads:
+            t.start()
+
+    def request(self, tile, priority):
+        with self.lock:
+            if tile in self.in_flight or self.pending.get(tile, priority + 1) <= priority:
+                return
+
+            self.pending[tile] = priority
+            heapq.heappush(self.queue, (priority, next(self.counter), tile))
+            self.available.notify()
+
+    def retain(self, tiles):
+        with self.lock:
+            for tile in [t for t in self.pending if t not in tiles]:
+                del self.pending[tile]
+
+            if len(self.queue) > 4 * len(self.pending) + 16:
+                self.queue = [e for e in self.queue if self.pending.get(e[2]) == e[0]]
+                heapq.heapify(self.queue)
+
+    def is_loading(self, tile):
+        with self.lock:
+            return tile in self.pending or tile in self.in_flight
+
+    def poll(self):
+        with self.lock:
+            done, self.done = self.done, []
+            return done
+
+    def worker(self):
+        while True:
+            with self.lock:
+                tile = None
+                while tile is None:
+                    while self.running and not self.queue:
+                        self.available.wait()
+                    if not self.running:
+                        return
+
+                    priority, _, tile = heapq.heappop(self.queue)
+                    if self.pending.get(tile) != priority:
+                        tile = None
+
+                del self.pending[tile]
+                self.in_flight.add(tile)
+
+            try:
+                image = self.load(tile)
+            except Exception as e:
+                print("LOAD %d (%d, %d) failed: %s" % (tile + (e,)))
+                image = None
+
+            with self.lock:
+                self.in_flight.discard(tile)
+                self.done.append((tile, image))
+
+            if self.notify is not None:
+                self.notify()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.available.notify_all()
+
+        for t in self.threads:
+            t.join()
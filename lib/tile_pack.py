@@ -0,0 +1,455 @@
+import argparse
+import fcntl
+import io
+import itertools
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import pygame
+
+from tile_source import HTTPTileSource
+
+MAGIC = b"OFFPACK\x01"
+
+# level, col, row, format, length, crc32
+RECORD = struct.Struct("<BiiBII")
+
+# width, height, pygame.image.frombuffer format
+RAW_HEADER = struct.Struct("<HH8s")
+
+# fetch time, followed by ETag and Last-Modified separated by a NUL
+META_HEADER = struct.Struct("<d")
+
+FORMAT_PNG = 0
+FORMAT_RAW = 1
+FORMAT_RAW_ZLIB = 2
+FORMAT_META = 3
+BUFFER_FORMATS = ("RGBX", "BGRA", "RGBA", "ARGB", "RGB", "BGR")
+
+
+class PackInUse(OSError):
+    pass
+
+
+class TilePack(object):
+    """
+    Append-only single-file tile store.
+
+    The file is a header followed by records of a fixed-size header and the
+    tile data. The offset index is rebuilt at open by walking the record
+    headers; a later record for the same tile replaces the earlier one. A torn
+    record at the end of the file (power cut during a write) is cut off when
+    the pack is opened for writing, and records failing their checksum on read
+    are treated as missing. Reads go through a memory map.
+
+    Only one process may have a pack open for writing, as each appends at
+    its own end of the file. A second writable open raises PackInUse.
+
+    FORMAT_META records hold the fetch time and HTTP validators of a tile and
+    are indexed separately from the tile data.
+    """
+
+    def __init__(self, path, writable=True):
+        self.path = path
+        self.writable = writable
+        self.lock = threading.Lock()
+        self.index = {}
+        self.meta = {}
+        self.map = None
+
+        if writable and not os.path.isfile(path):
+            with open(path, "wb") as f:
+                f.write(MAGIC)
+
+        self.file = open(path, "r+b" if writable else "rb")
+        if writable:
+            try:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self.file.close()
+                raise PackInUse("%s: pack in use by another process, e.g. the dashboard" % path) from None
+        if self.file.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a tile pack" % path)
+
+        self.end = self.scan()
+        if writable and self.end < os.path.getsize(path):
+            print("PACK %s: dropping %d trailing bytes" % (path, os.path.getsize(path) - self.end))
+            self.file.truncate(self.end)
+
+    def remap(self):
+        if self.map is not None:
+            self.map.close()
+        size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ) if size else None
+
+    def scan(self):
+        self.remap()
+        offset, last = self.walk(len(self.map))
+
+        if last is not None:
+            start, data_offset, length, crc = last
+            if zlib.crc32(self.map[data_offset:data_offset + length]) != crc:
+                self.index = {}
+                self.meta = {}
+                offset, last = self.walk(start)
+
+        return offset
+
+    def walk(self, size):
+        offset = len(MAGIC)
+        last = None
+        while offset + RECORD.size <= size:
+            level, col, row, fmt, length, crc = RECORD.unpack_from(self.map, offset)
+            data_offset = offset + RECORD.size
+            if length == 0 or data_offset + length > size:
+                break
+            last = offset, data_offset, length, crc
+            index = self.meta if fmt == FORMAT_META else self.index
+            index[(level, col, row)] = data_offset, length, fmt, crc
+            offset = data_offset + length
+
+        return offset, last
+
+    def __contains__(self, tile):
+        return tile in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def tiles(self):
+        return list(self.index)
+
+    def read(self, index, tile):
+        with self.lock:
+            entry = index.get(tile)
+            if entry is None:
+                return None
+
+            offset, length, fmt, crc = entry
+            if self.map is None or offset + length > len(self.map):
+                self.remap()
+            data = self.map[offset:offset + length]
+
+        if zlib.crc32(data) != crc:
+            print("PACK %s: corrupt record %d (%d, %d)" % ((self.path,) + tile))
+            with self.lock:
+                if index.get(tile) == entry:
+                    del index[tile]
+            return None
+
+        return data, fmt
+
+    def append(self, index, tile, data, fmt):
+        with self.lock:
+            crc = zlib.crc32(data)
+            self.file.seek(self.end)
+            self.file.write(RECORD.pack(*tile, fmt, len(data), crc) + data)
+            self.file.flush()
+
+            index[tile] = self.end + RECORD.size, len(data), fmt, crc
+            self.end += RECORD.size + len(data)
+
+    def get(self, tile, with_format=False):
+        entry = self.read(self.index, tile)
+        if entry is None or with_format:
+            return entry
+        return entry[0]
+
+    def put(self, tile, data, fmt=FORMAT_PNG):
+        self.append(self.index, tile, data, fmt)
+
+    def get_meta(self, tile):
+        """
+        Return (fetch time, ETag, Last-Modified) of the tile, or None.
+        """
+        entry = self.read(self.meta, tile)
+        if entry is None:
+            return None
+
+        data = entry[0]
+        etag, last_modified = data[META_HEADER.size:].decode("latin-1").split("\0")
+        return META_HEADER.unpack_from(data)[0], etag or None, last_modified or None
+
+    def put_meta(self, tile, fetched, etag=None, last_modified=None):
+        validators = "%s\0%s" % (etag or "", last_modified or "")
+        self.append(self.meta, tile, META_HEADER.pack(fetched) + validators.encode("latin-1"), FORMAT_META)
+
+    def sync(self):
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+            self.file.close()
+
+
+def buffer_format(surface):
+    """
+    Return the pygame.image.frombuffer format string matching the pixel layout of surface, or None.
+    """
+    masks = surface.get_masks()
+    for fmt in BUFFER_FORMATS:
+        probe = pygame.image.frombuffer(bytes(len(fmt)), (1, 1), fmt)
+        if probe.get_bitsize() == surface.get_bitsize() and probe.get_masks()[:3] == masks[:3]:
+            return fmt
+    return None
+
+
+def encode_raw(surface, fmt, compress=False):
+    header = RAW_HEADER.pack(surface.get_width(), surface.get_height(), fmt.encode("ascii"))
+    pixels = pygame.image.tobytes(surface, fmt)
+    if compress:
+        return header + zlib.compress(pixels, 1), FORMAT_RAW_ZLIB
+    return header + pixels, FORMAT_RAW
+
+
+def decode_tile(data, fmt):
+    """
+    Decode pack data into a surface in the display pixel format where possible.
+
+    Raw tiles stored in the display format are wrapped with frombuffer without
+    touching the pixels; PNG tiles are decoded and converted once.
+    """
+    display = pygame.display.get_surface()
+    if fmt == FORMAT_PNG:
+        image = pygame.image.load(io.BytesIO(data), "tile.png")
+        return image.convert() if display is not None else image
+
+    width, height, pixel_format = RAW_HEADER.unpack_from(data)
+    pixel_format = pixel_format.rstrip(b"\0").decode("ascii")
+    pixels = data[RAW_HEADER.size:]
+    if fmt == FORMAT_RAW_ZLIB:
+        pixels = zlib.decompress(pixels)
+
+    image = pygame.image.frombuffer(pixels, (width, height), pixel_format)
+    if display is not None:
+        if image.get_masks()[:3] != display.get_masks()[:3]:
+            image = image.convert()
+        elif not display.get_masks()[3]:
+            image.set_alpha(None)
+    return image
+
+
+def encode_like(png, like):
+    """
+    PNG tile data re-encoded as (data, format) in the format and pixel layout of the pack entry like.
+    """
+    data, fmt = like
+    if fmt == FORMAT_PNG:
+        return png, FORMAT_PNG
+
+    pixel_format = RAW_HEADER.unpack_from(data)[2].rstrip(b"\0").decode("ascii")
+    image = pygame.image.load(io.BytesIO(png), "tile.png")
+    return encode_raw(image, pixel_format, fmt == FORMAT_RAW_ZLIB)
+
+
+def bbox_tiles(west, south, east, north, levels):
+    from map_maker import TILE_SIZE, START_EAST, START_NORTH
+
+    for level in levels:
+        size = TILE_SIZE[level]
+        for row in range((south - START_NORTH) // size, (north - START_NORTH) // size + 1):
+            for col in range((west - START_EAST) // size, (east - START_EAST) // size + 1):
+                yield level, col, row
+
+
+def download(args):
+    import map_maker
+
+    pack = TilePack(args.pack)
+    levels = range(args.levels[0], args.levels[1] + 1)
+
+    def todo():
+        # a generator, the whole country is millions of tiles
+        return (tile for tile in bbox_tiles(*args.bbox, levels) if tile not in pack and map_maker.valid_tile(tile))
+
+    total = sum(1 for _ in todo())
+    print("%d tiles in pack, %d to download" % (len(pack), total))
+
+    source = HTTPTileSource(args.url, connections=args.workers)
+
+    def fetch(tile):
+        try:
+            return tile, source.fetch(tile)
+        except ConnectionError as e:
+            print("%d (%d, %d): %s" % (tile + (e,)))
+            return tile, None
+
+    done = 0
+    tiles = todo()
+    try:
+        with ThreadPoolExecutor(args.workers) as pool:
+            # bounded chunks, so only a few hundred futures and responses are held at a time
+            for chunk in iter(lambda: list(itertools.islice(tiles, 64 * args.workers)), []):
+                for tile, response in pool.map(fetch, chunk):
+                    if response is not None and response.status == 200:
+                        pack.put(tile, response.data)
+                        pack.put_meta(tile, time.time(), response.etag, response.last_modified)
+                    done += 1
+                    if done % 100 == 0:
+                        pack.sync()
+                        print("%d/%d" % (done, total))
+    finally:
+        source.close()
+        pack.sync()
+        pack.close()
+
+
+def tree_tiles(tree):
+    for level in sorted(os.listdir(tree)):
+        if not level.isdigit():
+            continue
+        for col in os.listdir(os.path.join(tree, level)):
+            if not col.isdigit():
+                continue
+            for name in os.listdir(os.path.join(tree, level, col)):
+                row, ext = os.path.splitext(name)
+                if ext == ".png" and row.isdigit():
+                    yield (int(level), int(col), int(row)), os.path.join(tree, level, col, name)
+
+
+def import_tree(args):
+    pack = TilePack(args.pack)
+    count = 0
+    for tile, path in tree_tiles(args.tree):
+        if tile in pack:
+            continue
+        with open(path, "rb") as f:
+            pack.put(tile, f.read())
+        # fetched now as far as revalidation is concerned
+        pack.put_meta(tile, time.time())
+        count += 1
+
+    pack.sync()
+    print("imported %d tiles, %d in pack" % (count, len(pack)))
+    pack.close()
+
+
+def convert(args):
+    pygame.display.init()
+    fmt = args.format or buffer_format(pygame.display.set_mode((1, 1)))
+    if fmt is None:
+        sys.exit("display pixel format has no frombuffer equivalent, use --format")
+
+    pack = TilePack(args.pack)
+    if args.tree:
+        sources = tree_tiles(args.tree)
+    else:
+        sources = ((tile, None) for tile in pack.tiles() if pack.index[tile][2] == FORMAT_PNG)
+
+    count = corrupt = 0
+    for tile, path in sources:
+        if path is None:
+            data = pack.get(tile)
+            if data is None:
+                corrupt += 1
+                continue
+            image = pygame.image.load(io.BytesIO(data), "tile.png")
+        else:
+            image = pygame.image.load(path)
+        if pygame.display.get_surface() is not None:
+            image = image.convert()
+        pack.put(tile, *encode_raw(image, fmt, args.compress))
+        if pack.get_meta(tile) is None:
+            pack.put_meta(tile, time.time())
+        count += 1
+        if count % 1000 == 0:
+            pack.sync()
+            print(count)
+
+    pack.sync()
+    print("converted %d tiles to %s%s, skipped %d corrupt" % (count, fmt, " (zlib)" if args.compress else "", corrupt))
+    pack.close()
+
+
+def compact(args):
+    # writable only for the lock, no other process may append while the pack is rewritten
+    pack = TilePack(args.pack)
+    tmp = args.pack + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+
+    out = TilePack(tmp)
+    corrupt = 0
+    for tile in sorted(pack.tiles()):
+        entry = pack.get(tile, with_format=True)
+        if entry is None:
+            corrupt += 1
+            continue
+        out.put(tile, *entry)
+        meta = pack.get_meta(tile)
+        if meta is not None:
+            out.put_meta(tile, *meta)
+    out.sync()
+    out.close()
+
+    os.replace(tmp, args.pack)
+    pack.close()
+    print("%d tiles, %d bytes, dropped %d corrupt" % (len(out), out.end, corrupt))
+
+
+def info(args):
+    pack = TilePack(args.pack, writable=False)
+    levels = {}
+    for level, col, row in pack.tiles():
+        levels[level] = levels.get(level, 0) + 1
+    for level in sorted(levels):
+        print("level %2d: %7d tiles" % (level, levels[level]))
+    print("total:    %7d tiles, %d bytes" % (len(pack), pack.end))
+    pack.close()
+
+
+def main(argv):
+    from map_maker import NORTH_BORDER, EAST_BORDER, WEST_BORDER, SOUTH_BORDER, TILE_URL
+
+    parser = argparse.ArgumentParser(description="Offline map tile pack tool")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("download", help="download a bounding box into a pack, resuming where it left off")
+    p.add_argument("pack")
+    p.add_argument("--bbox", type=int, nargs=4, metavar=("WEST", "SOUTH", "EAST", "NORTH"),
+                   default=(WEST_BORDER, SOUTH_BORDER, EAST_BORDER, NORTH_BORDER), help="TM35FIN metres")
+    p.add_argument("--levels", type=int, nargs=2, metavar=("MIN", "MAX"), default=(2, 10))
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--url", default=TILE_URL, help="tile URL template")
+    p.set_defaults(func=download)
+
+    p = commands.add_parser("import", help="import a maps/level/col/row.png tree into a pack")
+    p.add_argument("pack")
+    p.add_argument("tree", nargs="?", default="maps")
+    p.set_defaults(func=import_tree)
+
+    p = commands.add_parser("convert", help="store tiles pre-decoded in the display pixel format")
+    p.add_argument("pack")
+    p.add_argument("--tree", help="convert a maps/level/col/row.png tree instead of the PNG tiles in the pack")
+    p.add_argument("--format", choices=BUFFER_FORMATS, help="pixel format, default is the display format")
+    p.add_argument("--compress", action="store_true", help="zlib level 1 compression")
+    p.set_defaults(func=convert)
+
+    p = commands.add_parser("compact", help="rewrite the pack without replaced records")
+    p.add_argument("pack")
+    p.set_defaults(func=compact)
+
+    p = commands.add_parser("info", help="show tile counts per level")
+    p.add_argument("pack")
+    p.set_defaults(func=info)
+
+    args = parser.parse_args(argv)
+    try:
+        args.func(args)
+    except PackInUse as e:
+        sys.exit(str(e))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,178 @@
+import argparse
+import email.utils
+import io
+import os
+import random
+import re
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pygame
+
+from map_maker import valid_tile
+from tile_pack import TilePack, FORMAT_PNG, decode_tile
+
+TILE_PATH = re.compile(r"^/(?:[\w-]+/)*(\d+)/(\d+)/(\d+)\.png$")
+
+
+class PackTiles(object):
+    def __init__(self, path):
+        self.pack = TilePack(path, writable=False)
+
+    def get(self, tile):
+        entry = self.pack.get(tile, with_format=True)
+        if entry is None:
+            return None
+        data, fmt = entry
+        return data if fmt == FORMAT_PNG else encode_png(decode_tile(data, fmt))
+
+
+class TreeTiles(object):
+    def __init__(self, path):
+        self.path = path
+
+    def get(self, tile):
+        path = os.path.join(self.path, "%d/%d/%d.png" % tile)
+        if not os.path.isfile(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+
+class SyntheticTiles(object):
+    """
+    Generated tiles for anywhere inside the map borders, so no map data is needed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cache = {}
+
+    def get(self, tile):
+        if not valid_tile(tile):
+            return None
+
+        with self.lock:
+            data = self.cache.get(tile)
+            if data is None:
+                rnd = random.Random(hash(tile))
+                image = pygame.Surface((240, 240))
+                image.fill((rnd.randrange(160, 240), rnd.randrange(160, 240), rnd.randrange(140, 200)))
+                for _ in range(40):
+                    points = [(rnd.randrange(240), rnd.randrange(240)) for _ in range(2)]
+                    pygame.draw.line(image, (rnd.randrange(128),) * 3, *points, 2)
+                pygame.draw.rect(image, (0, 0, 0), image.get_rect(), 1)
+                data = self.cache[tile] = encode_png(image)
+            return data
+
+
+def encode_png(surface):
+    f = io.BytesIO()
+    pygame.image.save(surface, f, "tile.png")
+    return f.getvalue()
+
+
+class TileHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        server.requests += 1
+        if server.latency:
+            time.sleep(server.latency)
+
+        match = TILE_PATH.match(self.path)
+        if match is None:
+            return self.reply(404)
+        if server.fail_rate and random.random() < server.fail_rate:
+            return self.reply(503)
+
+        data = server.tiles.get(tuple(int(x) for x in match.groups()))
+        if data is None:
+            return self.reply(404)
+
+        etag = '"%08x"' % zlib.crc32(data)
+        if self.headers.get("If-None-Match") == etag:
+            return self.reply(304, etag=etag)
+
+        since = self.headers.get("If-Modified-Since")
+        if since and self.headers.get("If-None-Match") is None:
+            try:
+                if email.utils.parsedate_to_datetime(since).timestamp() >= int(server.modified):
+                    return self.reply(304, etag=etag)
+            except (TypeError, ValueError):
+                pass
+
+        self.reply(200, data, etag)
+
+    def reply(self, status, data=b"", etag=None):
+        self.send_response(status)
+        if etag:
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", email.utils.formatdate(self.server.modified, usegmt=True))
+        self.send_header("Content-Type", "image/png" if data else "text/plain")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class TileServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the tile server, with keep-alive, ETag and Last-Modified support.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, tiles, latency=0, fail_rate=0, verbose=False):
+        super().__init__(address, TileHandler)
+        self.tiles = tiles
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.verbose = verbose
+        self.modified = time.time()
+        self.requests = 0
+
+    @property
+    def url(self):
+        return "http://%s:%d/%%d/%%d/%%d.png" % self.server_address[:2]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Local stand-in tile server")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--pack", help="serve tiles from a tile pack")
+    source.add_argument("--tree", help="serve tiles from a maps/level/col/row.png tree")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0, help="seconds added to every request")
+    parser.add_argument("--fail-rate", type=float, default=0, help="fraction of requests answered with 503")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    if args.pack:
+        tiles = PackTiles(args.pack)
+    elif args.tree:
+        tiles = TreeTiles(args.tree)
+    else:
+        tiles = SyntheticTiles()
+
+    server = TileServer((args.host, args.port), tiles, args.latency, args.fail_rate, args.verbose)
+    print("serving %s" % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
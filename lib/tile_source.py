@@ -0,0 +1,175 @@
+import argparse
+import http.client
+import queue
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+
+class SourceOffline(ConnectionError):
+    """
+    The tile source cannot be reached, as opposed to one tile failing.
+    """
+
+
+class TileResponse(object):
+    def __init__(self, status, data=None, etag=None, last_modified=None):
+        self.status = status
+        self.data = data
+        self.etag = etag
+        self.last_modified = last_modified
+
+
+class HostPool(object):
+    """
+    Idle keep-alive connections to one host, at most `connections` in use at a time.
+    """
+
+    def __init__(self, scheme, netloc, connections, timeout):
+        self.connection_class = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        self.netloc = netloc
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(connections)
+        self.idle = queue.LifoQueue()
+
+    def acquire(self, fresh=False):
+        self.slots.acquire()
+        try:
+            if not fresh:
+                return self.idle.get_nowait(), True
+        except queue.Empty:
+            pass
+        return self.connection_class(self.netloc, timeout=self.timeout), False
+
+    def release(self, connection, reuse):
+        if reuse:
+            self.idle.put(connection)
+        else:
+            connection.close()
+        self.slots.release()
+
+    def clear(self):
+        """
+        Close the idle connections, after a long pause the server has likely closed all of them.
+        """
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class HTTPTileSource(object):
+    """
+    Fetches tiles over pooled keep-alive HTTP connections.
+
+    fetch() returns a TileResponse for 200, 304 and 404 and raises
+    ConnectionError for anything else. After a connection failure the source
+    is considered offline for `offline_delay` seconds and fails fast, so a
+    drive without coverage does not stall the tile workers on timeouts. Both
+    the failure and the fast fails raise SourceOffline.
+    """
+
+    def __init__(self, url, connections=2, timeout=10, offline_delay=30):
+        self.url = url
+        self.connections = connections
+        self.timeout = timeout
+        self.offline_delay = offline_delay
+        self.offline_until = 0
+
+        self.lock = threading.Lock()
+        self.pools = {}
+
+    def pool(self, scheme, netloc):
+        with self.lock:
+            pool = self.pools.get(netloc)
+            if pool is None:
+                pool = self.pools[netloc] = HostPool(scheme, netloc, self.connections, self.timeout)
+            return pool
+
+    def offline(self):
+        return time.monotonic() < self.offline_until
+
+    def fetch(self, tile, etag=None, last_modified=None):
+        if self.offline():
+            raise SourceOffline("tile source offline")
+
+        url = urllib.parse.urlsplit(self.url % tile)
+        path = url.path + ("?" + url.query if url.query else "")
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+        pool = self.pool(url.scheme, url.netloc)
+        fresh = False
+        while True:
+            connection, reused = pool.acquire(fresh)
+            try:
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                pool.release(connection, False)
+                if reused:
+                    # the server closed an idle keep-alive connection, and likely the other idle ones
+                    # too, retry on a fresh one; only a fresh connection failing means offline
+                    pool.clear()
+                    fresh = True
+                    continue
+                self.offline_until = time.monotonic() + self.offline_delay
+                raise SourceOffline("%s: %s" % (self.url % tile, e))
+
+            pool.release(connection, not response.will_close)
+            break
+
+        if response.status not in (200, 304, 404):
+            raise ConnectionError("%s: HTTP %d %s" % (self.url % tile, response.status, response.reason))
+
+        return TileResponse(response.status, data if response.status == 200 else None,
+                            response.getheader("ETag"), response.getheader("Last-Modified"))
+
+    def close(self):
+        with self.lock:
+            for pool in self.pools.values():
+                pool.clear()
+
+
+def bench(args):
+    from concurrent.futures import ThreadPoolExecutor
+
+    tiles = [(args.level, args.col + i % 16, args.row + i // 16) for i in range(args.tiles)]
+
+    def fresh(tile):
+        with urllib.request.urlopen(args.url % tile) as response:
+            return response.read()
+
+    source = HTTPTileSource(args.url, connections=args.connections)
+
+    for name, fetch in (("urlopen", fresh), ("pooled", lambda tile: source.fetch(tile).data)):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(args.connections) as pool:
+            size = sum(len(data or b"") for data in pool.map(fetch, tiles))
+        elapsed = time.perf_counter() - start
+        print("%-8s %6d tiles %8.1f tiles/s %8.2f ms/tile %10d bytes" % (
+            name, len(tiles), len(tiles) / elapsed, 1000 * elapsed / len(tiles), size))
+
+    source.close()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Tile source benchmark")
+    parser.add_argument("url", help="tile URL template, e.g. http://127.0.0.1:8080/%%d/%%d/%%d.png")
+    parser.add_argument("--tiles", type=int, default=500)
+    parser.add_argument("--connections", type=int, default=2)
+    parser.add_argument("--level", type=int, default=8)
+    parser.add_argument("--col", type=int, default=150)
+    parser.add_argument("--row", type=int, default=60)
+    bench(parser.parse_args(argv))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])